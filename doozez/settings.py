@@ -228,3 +228,84 @@ APSCHEDULER_DATETIME_FORMAT = "N j, Y, f:s a"
 # that supports multiple background worker processes instead (e.g. Dramatiq, Celery, Django-RQ,
 # etc. See: https://djangopackages.org/grids/g/workers-queues-tasks/ for popular options).
 APSCHEDULER_RUN_NOW_TIMEOUT = 25  # Seconds
+
+# Number of executor workers `runapscheduler` starts for each of the job and event queues. Each worker
+# claims a different DoozezJob/Event (FOR UPDATE SKIP LOCKED), so throughput grows with the worker count.
+DOOZEZ_EXECUTOR_WORKERS = int(os.getenv('DOOZEZ_EXECUTOR_WORKERS', 1))
+
+# Budget of a single scheduler tick. A worker keeps claiming and running tasks/events until its queue is
+# empty or one of these limits is reached, then yields until the next tick.
+DOOZEZ_EXECUTOR_TICK_MAX_EXECUTIONS = int(os.getenv('DOOZEZ_EXECUTOR_TICK_MAX_EXECUTIONS', 500))
+DOOZEZ_EXECUTOR_TICK_MAX_SECONDS = float(os.getenv('DOOZEZ_EXECUTOR_TICK_MAX_SECONDS', 9))
+
+# Schedulers block on Postgres LISTEN and are woken up by NOTIFY when jobs or webhook events are created.
+# Drains that stop on their tick budget run again right away and deferred jobs and events wake the scheduler
+# when they are due, so polling every DOOZEZ_EXECUTOR_POLL_SECONDS is only a fallback for missed notifications.
+DOOZEZ_EXECUTOR_LISTEN = os.getenv('DOOZEZ_EXECUTOR_LISTEN', 'true').lower() == 'true'
+DOOZEZ_EXECUTOR_POLL_SECONDS = int(os.getenv('DOOZEZ_EXECUTOR_POLL_SECONDS', 60 if DOOZEZ_EXECUTOR_LISTEN else 10))
+
+# Webhook events announcing a resource the gateway is still creating, e.g. the payments of a new instalment
+# schedule, are handled again every DOOZEZ_EVENT_RETRY_SECONDS and fail after DOOZEZ_EVENT_RETRY_MAX_SECONDS.
+DOOZEZ_EVENT_RETRY_SECONDS = int(os.getenv('DOOZEZ_EVENT_RETRY_SECONDS', 60))
+DOOZEZ_EVENT_RETRY_MAX_SECONDS = int(os.getenv('DOOZEZ_EVENT_RETRY_MAX_SECONDS', 86400))
+
+# Size of the thread pool a JobExecutor runs the ready tasks of a job on. Tasks only wait for the tasks they
+# declare as dependencies, e.g. the draw of a safe start waits for all of its CreatePayment tasks.
+DOOZEZ_TASK_POOL_SIZE = int(os.getenv('DOOZEZ_TASK_POOL_SIZE', 8))
+
+# With DOOZEZ_TASK_PROCESSES > 0 task functions run in that many worker processes instead of the thread pool,
+# which sidesteps the GIL for CPU heavy tasks and keeps a misbehaving task away from the scheduler.
+DOOZEZ_TASK_PROCESSES = int(os.getenv('DOOZEZ_TASK_PROCESSES', 0))
+
+# Per task type overrides of the retry policies in safe/retry.py, keyed by DoozezTaskType value, e.g.
+# {'CTP': {'max_attempts': 8, 'base_delay': 5.0}}. Failed tasks are retried with exponential backoff and jitter.
+DOOZEZ_TASK_RETRY_POLICIES = {}
+
+# Workers lease the jobs, events and tasks they claim for DOOZEZ_LEASE_SECONDS and renew the leases of the
+# tasks they are running every DOOZEZ_HEARTBEAT_SECONDS. Running rows whose lease expired belong to a crashed
+# worker and are reclaimed by the lease reaper, so a crash costs at most one lease interval.
+DOOZEZ_LEASE_SECONDS = int(os.getenv('DOOZEZ_LEASE_SECONDS', 120))
+DOOZEZ_HEARTBEAT_SECONDS = int(os.getenv('DOOZEZ_HEARTBEAT_SECONDS', DOOZEZ_LEASE_SECONDS // 4))
+
+# Jobs (with their tasks) and events that finished more than DOOZEZ_RETENTION_DAYS ago are moved into the
+# archive tables, DOOZEZ_RETENTION_CHUNK_SIZE rows per transaction. See `manage.py archiveexecutables`.
+DOOZEZ_RETENTION_DAYS = int(os.getenv('DOOZEZ_RETENTION_DAYS', 30))
+DOOZEZ_RETENTION_CHUNK_SIZE = int(os.getenv('DOOZEZ_RETENTION_CHUNK_SIZE', 1000))
+
+# Jobs and tasks are claimed by priority (0 low, 1 normal, 2 high), FIFO within a priority level. Levels are
+# served weighted fair, see safe/priorities.py, e.g. DOOZEZ_PRIORITY_WEIGHTS = {2: 8} doubles the share of high
+# priority jobs. Priorities are set per DoozezJobType/DoozezTaskType value, e.g. {'SSF': 2}.
+DOOZEZ_PRIORITY_WEIGHTS = {}
+DOOZEZ_JOB_PRIORITIES = {}
+DOOZEZ_TASK_PRIORITIES = {}
+
+# With DOOZEZ_ASYNC_EVENTS the scheduler handles webhook events on an asyncio loop, keeping up to
+# DOOZEZ_ASYNC_EVENT_CONCURRENCY of them in flight while they wait on the payment gateway. Their database steps
+# run on DOOZEZ_ASYNC_DATABASE_THREADS threads, i.e. as many database connections.
+DOOZEZ_ASYNC_EVENTS = os.getenv('DOOZEZ_ASYNC_EVENTS', 'false').lower() == 'true'
+DOOZEZ_ASYNC_EVENT_CONCURRENCY = int(os.getenv('DOOZEZ_ASYNC_EVENT_CONCURRENCY', 100))
+DOOZEZ_ASYNC_DATABASE_THREADS = int(os.getenv('DOOZEZ_ASYNC_DATABASE_THREADS', 4))
+
+# Executor metrics are served on /metrics. The scheduler process pushes its own to the Prometheus pushgateway
+# at DOOZEZ_METRICS_PUSHGATEWAY (e.g. localhost:9091) every DOOZEZ_METRICS_PUSH_SECONDS, unset disables pushing.
+DOOZEZ_METRICS_PUSHGATEWAY = os.getenv('DOOZEZ_METRICS_PUSHGATEWAY', '')
+DOOZEZ_METRICS_PUSH_SECONDS = int(os.getenv('DOOZEZ_METRICS_PUSH_SECONDS', 15))
+# /metrics is only served with an `Authorization: Bearer <DOOZEZ_METRICS_TOKEN>` header, unset disables it.
+DOOZEZ_METRICS_TOKEN = os.getenv('DOOZEZ_METRICS_TOKEN', '')
+
+# Gateway requests made for all participants of a safe at once, e.g. creating their instalment schedules, run on
+# up to DOOZEZ_GATEWAY_CONCURRENCY threads.
+DOOZEZ_GATEWAY_CONCURRENCY = int(os.getenv('DOOZEZ_GATEWAY_CONCURRENCY', 10))
+# All requests to the payment gateway go through one keep-alive connection pool per process holding up to
+# DOOZEZ_GATEWAY_POOL_SIZE connections, they time out after the connect and read timeouts (in seconds).
+DOOZEZ_GATEWAY_POOL_SIZE = int(os.getenv('DOOZEZ_GATEWAY_POOL_SIZE', 20))
+DOOZEZ_GATEWAY_CONNECT_TIMEOUT = float(os.getenv('DOOZEZ_GATEWAY_CONNECT_TIMEOUT', 5))
+DOOZEZ_GATEWAY_READ_TIMEOUT = float(os.getenv('DOOZEZ_GATEWAY_READ_TIMEOUT', 30))
+
+# Lookups of gateway mandates, payments and instalment schedules are cached for DOOZEZ_GATEWAY_CACHE_TTL seconds
+# and evicted when a webhook event about them arrives. DOOZEZ_GATEWAY_CACHE is 'local' for an in-process LRU of
+# DOOZEZ_GATEWAY_CACHE_SIZE entries, the alias of one of the CACHES to share them between processes, or empty to
+# disable caching.
+DOOZEZ_GATEWAY_CACHE = os.getenv('DOOZEZ_GATEWAY_CACHE', 'local')
+DOOZEZ_GATEWAY_CACHE_TTL = int(os.getenv('DOOZEZ_GATEWAY_CACHE_TTL', 60))
+DOOZEZ_GATEWAY_CACHE_SIZE = int(os.getenv('DOOZEZ_GATEWAY_CACHE_SIZE', 1000))
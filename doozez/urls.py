@@ -19,7 +19,7 @@ from django.urls import path, include
 from fcm_django.api.rest_framework import FCMDeviceAuthorizedViewSet
 
 from allauth.account.views import confirm_email
-from safe.views import ConfirmatioView, PasswordResetView
+from safe.views import ConfirmatioView, PasswordResetView, metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -32,4 +32,5 @@ urlpatterns = [
     url(r'^auth/password_reset_confirm/', PasswordResetView.as_view(), name='password_reset_confirm'),
     url('confirmation', ConfirmatioView.as_view(), name='confirmation'),
     path('devices', FCMDeviceAuthorizedViewSet.as_view({'post': 'create'}), name='create_fcm_device'),
+    path('metrics', metrics, name='metrics'),
 ]
@@ -0,0 +1,193 @@
+import itertools
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .client_interfaces import GCPayment
+from .decorators import doozez_task
+from .models import DoozezJob, DoozezTask, DoozezTaskType, Event, DoozezExecutableStatus, DoozezTaskStatus, \
+    Mandate, ParticipantRole, Participation, Payment, PaymentMethod, PaymentMethodStatus, Product, Safe
+from .services import Executor, EventExecutor, EventService, JobExecutor, JobService, ParticipationService, \
+    PaymentService, SafeService, UserService
+from .tasks import draw, create_payment_for_participant
+
+
+class FakePaymentGatewayClient(object):
+    """
+    In-memory stand-in for PaymentGatewayClient. Every call sleeps `latency` seconds to mimic the round trip
+    to GoCardless.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.ids = itertools.count(1)
+        self.payments = {}
+        self.lock = threading.Lock()
+
+    def create_payment(self, mandate_id, amount, currency="GBP", idempotency_key=None):
+        time.sleep(self.latency)
+        with self.lock:
+            payment = GCPayment(id="PM{}".format(next(self.ids)), created_at="2021-11-01",
+                                status="pending_submission", amount=int(float(amount)), currency=currency,
+                                mandate=mandate_id, charge_date="2021-11-22")
+            self.payments[payment.id] = payment
+        return payment
+
+    def get_payment(self, payment_id):
+        time.sleep(self.latency)
+        return self.payments.get(payment_id)
+
+
+class TimedExecutor(Executor):
+    # records how long each claim takes
+    def __init__(self, executable_service):
+        super().__init__(executable_service)
+        self.claim_latencies = []
+
+    def runNextExecutable(self):
+        started = time.perf_counter()
+        try:
+            return super().runNextExecutable()
+        finally:
+            self.claim_latencies.append(time.perf_counter() - started)
+
+
+def percentiles(values, scale=1.0):
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+
+    def nearest_rank(p):
+        return round(values[min(len(values) - 1, max(0, int(round(p * len(values))) - 1))] * scale, 3)
+
+    return {"p50": nearest_rank(0.50), "p95": nearest_rank(0.95), "p99": nearest_rank(0.99),
+            "max": round(values[-1] * scale, 3)}
+
+
+def rate(count, seconds):
+    return round(count / seconds, 3) if seconds > 0 else None
+
+
+class ExecutorBenchmark(object):
+    """
+    Seeds `safes` started safes with `participants` participants each and runs their StartSafe jobs, then the
+    payment confirmed webhook events the jobs lead to, to completion against a FakePaymentGatewayClient.
+    Reports throughput, claim latency, database queries per task/event and end-to-end latency, i.e. from the
+    creation of a job/event until it finished. Queries are only counted on the scheduler's connection, so use a
+    task pool size of 1 when comparing them.
+    """
+
+    def __init__(self, safes=10, participants=5, task_pool_size=1, gateway_latency=0.0):
+        self.safes = safes
+        self.participants = participants
+        self.task_pool_size = task_pool_size
+        self.gateway = FakePaymentGatewayClient(gateway_latency)
+
+    def registerTasks(self):
+        participation_service = ParticipationService()
+        payment_service = PaymentService()
+        payment_service.payment_gate_way_client = self.gateway
+
+        @doozez_task(type=DoozezTaskType.Draw)
+        def benchmark_draw(safe_id):
+            draw(safe_id, participation_service)
+
+        @doozez_task(type=DoozezTaskType.CreatePayment)
+        def benchmark_create_payment(participation_id, amount, currency):
+            create_payment_for_participant(participation_id, amount, currency, payment_service)
+
+    def seed(self):
+        User = get_user_model()
+        system_payment_method = PaymentMethod.objects.filter(user=UserService().getSystemUser()).first()
+        if system_payment_method.mandate is None:
+            system_payment_method.mandate = Mandate.objects.create(mandate_external_id="MD_SYSTEM")
+            system_payment_method.save()
+        product = Product.objects.create(name="benchmark", price=10)
+        participation_service = ParticipationService()
+        safe_service = SafeService()
+        for i in range(self.safes):
+            users = []
+            for j in range(self.participants):
+                user = User.objects.create_user(email='benchmark-{}-{}@doozez.co.uk'.format(i, j), password='foo')
+                mandate = Mandate.objects.create(mandate_external_id="MD{}-{}".format(i, j))
+                payment_method = PaymentMethod.objects.create(user=user, is_default=True, mandate=mandate,
+                                                              status=PaymentMethodStatus.ExternallyActivated)
+                users.append((user, payment_method))
+            initiator = users[0][0]
+            safe = Safe.objects.create(name='benchmark-{}'.format(i), monthly_payment=10,
+                                       total_participants=self.participants, initiator=initiator)
+            participation_service.createParticipationForSystemUser(safe)
+            for j, (user, payment_method) in enumerate(users):
+                Participation.objects.create(user=user, safe=safe, payment_method=payment_method, product=product,
+                                             user_role=ParticipantRole.Initiator if j == 0 else
+                                             ParticipantRole.Participant)
+            safe_service.startSafe(initiator, safe, force=True)
+
+    def createPaymentEvents(self):
+        service = EventService()
+        for payment in Payment.objects.all():
+            service.createEvent("EV{}".format(payment.pk), "2021-11-01", "payments", "confirmed", str(payment.pk),
+                                "payment_confirmed", "benchmark")
+
+    def runJobs(self):
+        executor = JobExecutor(task_pool_size=self.task_pool_size, task_processes=0)
+        executor.executor = TimedExecutor(JobService())
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            executor.executeRunnableJobs(max_executions=float('inf'), max_seconds=float('inf'))
+            elapsed = time.perf_counter() - started
+        return elapsed, len(queries.captured_queries), executor.executor.claim_latencies
+
+    def runEvents(self):
+        executor = EventExecutor()
+        executor.executor = TimedExecutor(EventService())
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            executor.executeRunnableJobs(max_executions=float('inf'), max_seconds=float('inf'))
+            elapsed = time.perf_counter() - started
+        return elapsed, len(queries.captured_queries), executor.executor.claim_latencies
+
+    @staticmethod
+    def completionLatencies(executables):
+        return [(executable.updated_at - executable.created_on).total_seconds() for executable in executables]
+
+    def run(self):
+        self.registerTasks()
+        self.seed()
+        jobs_elapsed, jobs_queries, job_claims = self.runJobs()
+        self.createPaymentEvents()
+        events_elapsed, events_queries, event_claims = self.runEvents()
+        jobs = list(DoozezJob.objects.all())
+        tasks = DoozezTask.objects.filter(status=DoozezTaskStatus.Successful).count()
+        events = list(Event.objects.all())
+        return {
+            "config": {
+                "safes": self.safes,
+                "participants": self.participants,
+                "task_pool_size": self.task_pool_size,
+                "gateway_latency_ms": self.gateway.latency * 1000,
+            },
+            "jobs": {
+                "count": len(jobs),
+                "failed": len([job for job in jobs if job.status != DoozezExecutableStatus.Successful]),
+                "per_second": rate(len(jobs), jobs_elapsed),
+                "claim_latency_ms": percentiles(job_claims, 1000),
+                "latency_ms": percentiles(self.completionLatencies(jobs), 1000),
+            },
+            "tasks": {
+                "count": tasks,
+                "per_second": rate(tasks, jobs_elapsed),
+                "queries_per_task": round(jobs_queries / tasks, 3) if tasks else None,
+            },
+            "events": {
+                "count": len(events),
+                "failed": len([event for event in events if event.status != DoozezExecutableStatus.Successful]),
+                "per_second": rate(len(events), events_elapsed),
+                "claim_latency_ms": percentiles(event_claims, 1000),
+                "latency_ms": percentiles(self.completionLatencies(events), 1000),
+                "queries_per_event": round(events_queries / len(events), 3) if events else None,
+            },
+        }
@@ -1,7 +1,17 @@
+import asyncio
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
 from django.core.exceptions import ValidationError
 import gocardless_pro
+import requests
+from gocardless_pro.api_client import ApiClient
+from requests.adapters import HTTPAdapter
 
-from . import utils
+from . import gateway_cache, utils
 
 
 class GCInstalmentSchedule(object):
@@ -36,8 +46,10 @@ class GCPayment(object):
     mandate = ""
     charge_date = ""
     idempotency_key = ""
+    instalment_schedule = ""
 
-    def __init__(self, id, created_at, status, amount, currency, mandate, charge_date="", idempotency_key=""):
+    def __init__(self, id, created_at, status, amount, currency, mandate, charge_date="", idempotency_key="",
+                 instalment_schedule=""):
         self.id = id
         self.created_at = created_at
         self.status = status
@@ -46,6 +58,7 @@ class GCPayment(object):
         self.mandate = mandate
         self.charge_date = charge_date
         self.idempotency_key = idempotency_key
+        self.instalment_schedule = instalment_schedule
 
 
 class GCInstalment(object):
@@ -96,6 +109,64 @@ class RedirectFlow(object):
         self.redirect_url = redirect_url
 
 
+class PooledApiClient(ApiClient):
+    """
+    gocardless_pro's ApiClient sending its requests through a shared requests.Session instead of a new
+    connection per request, so calls reuse kept-alive TCP/TLS connections. The session's connection pool is
+    thread safe, one client serves every thread of the process.
+    """
+
+    def __init__(self, base_url, access_token, session, timeout):
+        super().__init__(base_url, access_token)
+        self.session = session
+        self.timeout = timeout
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        response = self.session.request(method, self._url_for(path), params=params,
+                                        data=None if body is None else json.dumps(body),
+                                        headers=self._headers(headers), timeout=self.timeout)
+        self._handle_errors(response)
+        return response
+
+    def get(self, path, params=None, headers=None):
+        return self.request('GET', path, params=params, headers=headers)
+
+    def post(self, path, body, headers=None):
+        return self.request('POST', path, body=body, headers=headers)
+
+    def put(self, path, body, headers=None):
+        return self.request('PUT', path, body=body, headers=headers)
+
+    def delete(self, path, body, headers=None):
+        return self.request('DELETE', path, body=body, headers=headers)
+
+
+__gateway_clients = {}
+__gateway_clients_lock = threading.Lock()
+
+
+def get_gateway_client(access_token, environment):
+    """
+    The process wide gocardless_pro client for an access token and environment. Its connection pool keeps up to
+    DOOZEZ_GATEWAY_POOL_SIZE connections alive, requests time out after DOOZEZ_GATEWAY_CONNECT_TIMEOUT and
+    DOOZEZ_GATEWAY_READ_TIMEOUT seconds.
+    """
+    key = (access_token, environment)
+    with __gateway_clients_lock:
+        client = __gateway_clients.get(key)
+        if client is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.DOOZEZ_GATEWAY_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            client = gocardless_pro.Client(access_token=access_token, environment=environment)
+            client._api_client = PooledApiClient(client._api_client.base_url, access_token, session,
+                                                 (settings.DOOZEZ_GATEWAY_CONNECT_TIMEOUT,
+                                                  settings.DOOZEZ_GATEWAY_READ_TIMEOUT))
+            __gateway_clients[key] = client
+        return client
+
+
 class PaymentGatewayClient(object):
     client = None
     access_token = ""
@@ -106,13 +177,8 @@ class PaymentGatewayClient(object):
         self.environment = environment
 
     def __build_client(self):
-        self.client = gocardless_pro.Client(
-            # We recommend storing your access token in an
-            # environment variable for security
-            access_token=self.access_token,
-            # Change this to 'live' when you are ready to go live.
-            environment=self.environment
-        )
+        # shared by all services of the process, see get_gateway_client
+        self.client = get_gateway_client(self.access_token, self.environment)
         return self.client
 
     def get_client(self):
@@ -148,13 +214,17 @@ class PaymentGatewayClient(object):
     def get_mandate(self, mandate_id):
         if mandate_id is None or mandate_id == "":
             raise ValidationError("mandate id can not be empty")
+        return gateway_cache.cached_lookup(gateway_cache.MANDATES, mandate_id, self.fetch_mandate)
+
+    def fetch_mandate(self, mandate_id):
         mandate = self.get_client().mandates.get(mandate_id)
         if mandate is None:
             return None
         return GCMandate(mandate_id, mandate.scheme, mandate.status)
 
-    def create_payment(self, mandate_id, amount, currency="GBP"):
-        idempotency_key = utils.id_generator()
+    def create_payment(self, mandate_id, amount, currency="GBP", idempotency_key=None):
+        if idempotency_key is None:
+            idempotency_key = utils.id_generator()
         gc_amount = int(float(amount))
         payment = self.get_client().payments.create(
             params={
@@ -177,12 +247,39 @@ class PaymentGatewayClient(object):
                          idempotency_key=idempotency_key)
 
     def get_payment(self, payment_id):
+        return gateway_cache.cached_lookup(gateway_cache.PAYMENTS, payment_id, self.fetch_payment)
+
+    def fetch_payment(self, payment_id):
         payment = self.get_client().payments.get(payment_id)
         return GCPayment(id=payment.id, created_at=payment.created_at, status=payment.status, amount=payment.amount,
                          currency=payment.currency,
                          mandate=payment.links.mandate, charge_date=payment.charge_date)
 
+    def list_payments(self, mandate_id, instalment_schedule_id=None, page_size=500, expected=None):
+        """
+        All payments of a mandate, fetched page by page, optionally only those of one instalment schedule.
+        The list endpoint filters by mandate, payments are matched to the schedule by their links. With
+        `expected` no further pages are fetched once that many payments matched.
+        """
+        payments = self.get_client().payments.all(params={"mandate": mandate_id, "limit": page_size})
+        result = []
+        for payment in payments:
+            gc_payment = GCPayment(id=payment.id, created_at=payment.created_at, status=payment.status,
+                                   amount=payment.amount, currency=payment.currency, mandate=payment.links.mandate,
+                                   charge_date=payment.charge_date,
+                                   instalment_schedule=payment.links.instalment_schedule)
+            # listed payments are as fresh as fetched ones, later lookups of them are served from the cache
+            gateway_cache.store(gateway_cache.PAYMENTS, gc_payment.id, gc_payment)
+            if instalment_schedule_id is None or gc_payment.instalment_schedule == instalment_schedule_id:
+                result.append(gc_payment)
+                if expected is not None and len(result) >= expected:
+                    break
+        return result
+
     def get_instalment(self, instalment_id):
+        return gateway_cache.cached_lookup(gateway_cache.INSTALMENT_SCHEDULES, instalment_id, self.fetch_instalment)
+
+    def fetch_instalment(self, instalment_id):
         instalment = self.get_client().instalment_schedules.get(instalment_id)
         return GCInstalment(id=instalment.id,
                             created_at=instalment.created_at,
@@ -192,8 +289,10 @@ class PaymentGatewayClient(object):
                             payments=instalment.links.payments)
 
     def create_instalment_with_schedule(self, name, mandate_id, total_amount, app_fee, amounts,
-                                        currency, start_date, interval, interval_unit='monthly'):
-        idempotency_key = utils.id_generator()
+                                        currency, start_date, interval, interval_unit='monthly',
+                                        idempotency_key=None):
+        # with a stable key a retried request returns the schedule created before instead of a second one
+        idempotency_key = idempotency_key or utils.id_generator()
         instalment_schedule = self.get_client().instalment_schedules.create_with_schedule(
             params={
                 "name": name,
@@ -219,3 +318,46 @@ class PaymentGatewayClient(object):
                                     total_amount=instalment_schedule.amount,
                                     currency=instalment_schedule.currency, mandate=instalment_schedule.links.mandate,
                                     idempotency_key=idempotency_key)
+
+
+class AsyncPaymentGatewayClient(object):
+    """
+    asyncio counterpart of PaymentGatewayClient returning the same DTOs. gocardless_pro only ships a blocking
+    client, its calls are run on a thread pool sized for the number of requests kept in flight.
+    """
+
+    def __init__(self, access_token=None, environment=None, client=None, max_in_flight=100):
+        self.client = client or PaymentGatewayClient(access_token, environment)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="doozez-gateway")
+
+    async def call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(getattr(self.client, method),
+                                                                           *args, **kwargs))
+
+    async def create_approval_flow(self, description, session_token, success_redirect_url, user):
+        return await self.call("create_approval_flow", description, session_token, success_redirect_url, user)
+
+    async def complete_approval_flow(self, flow_id, session_token):
+        return await self.call("complete_approval_flow", flow_id, session_token)
+
+    async def get_mandate(self, mandate_id):
+        return await self.call("get_mandate", mandate_id)
+
+    async def create_payment(self, mandate_id, amount, currency="GBP", idempotency_key=None):
+        return await self.call("create_payment", mandate_id, amount, currency, idempotency_key)
+
+    async def get_payment(self, payment_id):
+        return await self.call("get_payment", payment_id)
+
+    async def list_payments(self, mandate_id, instalment_schedule_id=None, page_size=500, expected=None):
+        return await self.call("list_payments", mandate_id, instalment_schedule_id, page_size, expected)
+
+    async def get_instalment(self, instalment_id):
+        return await self.call("get_instalment", instalment_id)
+
+    async def create_instalment_with_schedule(self, name, mandate_id, total_amount, app_fee, amounts,
+                                              currency, start_date, interval, interval_unit='monthly',
+                                              idempotency_key=None):
+        return await self.call("create_instalment_with_schedule", name, mandate_id, total_amount, app_fee, amounts,
+                               currency, start_date, interval, interval_unit, idempotency_key)
@@ -21,3 +21,25 @@ def run(type: str, *args, **kargs):
 
 def clear():
     __tasks = {}
+
+
+__event_handlers = {}
+
+
+def doozez_event_handler(_func=None, *, resource_type: str, action: str, asynchronous=False):
+    """
+    Registers an executor method as the handler of a gateway event. The method name is stored, executors look
+    it up on themselves so a handler replaced on an instance is used.
+    """
+    def decorator_doozez_event_handler(func):
+        __event_handlers[(resource_type, action, asynchronous)] = func.__name__
+        return func
+
+    if _func is None:
+        return decorator_doozez_event_handler
+    else:
+        return decorator_doozez_event_handler(_func)
+
+
+def event_handler_name(resource_type: str, action: str, asynchronous=False):
+    return __event_handlers.get((resource_type, action, asynchronous))
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+MANDATES = 'mandates'
+PAYMENTS = 'payments'
+INSTALMENT_SCHEDULES = 'instalment_schedules'
+
+
+def cache_key(resource_type, resource_id):
+    # resource types are named like the webhook events about them, so an event evicts its resource
+    return 'doozez:gateway:{}:{}'.format(resource_type, resource_id)
+
+
+class LocalGatewayCache(object):
+    """
+    In-process LRU holding up to `size` gateway resources for `ttl` seconds each.
+    """
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class DjangoGatewayCache(object):
+    """
+    Keeps gateway resources in one of the Django cache backends, shared by every process using that backend.
+    """
+
+    def __init__(self, alias, ttl):
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+__gateway_cache = None
+__gateway_cache_lock = threading.Lock()
+
+
+def get_gateway_cache():
+    """
+    The cache configured with DOOZEZ_GATEWAY_CACHE: 'local' for the in-process LRU, the alias of a Django cache
+    or '' to disable caching, in which case None is returned.
+    """
+    global __gateway_cache
+    backend = settings.DOOZEZ_GATEWAY_CACHE
+    if not backend:
+        return None
+    with __gateway_cache_lock:
+        if __gateway_cache is None:
+            if backend == 'local':
+                __gateway_cache = LocalGatewayCache(settings.DOOZEZ_GATEWAY_CACHE_TTL,
+                                                    settings.DOOZEZ_GATEWAY_CACHE_SIZE)
+            else:
+                __gateway_cache = DjangoGatewayCache(backend, settings.DOOZEZ_GATEWAY_CACHE_TTL)
+        return __gateway_cache
+
+
+def clear():
+    # drops the cache of this process, the next lookup builds it again from the current settings
+    global __gateway_cache
+    with __gateway_cache_lock:
+        __gateway_cache = None
+
+
+def cached_lookup(resource_type, resource_id, fetch):
+    """
+    Read-through lookup of a gateway resource, `fetch` is only called on a miss.
+    """
+    cache = get_gateway_cache()
+    if cache is None:
+        return fetch(resource_id)
+    key = cache_key(resource_type, resource_id)
+    resource = cache.get(key)
+    if resource is None:
+        resource = fetch(resource_id)
+        if resource is not None:
+            cache.set(key, resource)
+    return resource
+
+
+def store(resource_type, resource_id, resource):
+    cache = get_gateway_cache()
+    if cache is not None:
+        cache.set(cache_key(resource_type, resource_id), resource)
+
+
+def evict(resource_type, resource_id):
+    cache = get_gateway_cache()
+    if cache is not None and resource_id:
+        cache.delete(cache_key(resource_type, resource_id))
@@ -0,0 +1,19 @@
+import datetime
+import os
+import socket
+
+from django.conf import settings
+from django.utils import timezone
+
+
+def worker_id():
+    """
+    Identifies the worker process holding a lease, e.g. `scheduler-1:4711`.
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def lease_expiry(lease_seconds=None):
+    if lease_seconds is None:
+        lease_seconds = settings.DOOZEZ_LEASE_SECONDS
+    return timezone.now() + datetime.timedelta(seconds=lease_seconds)
@@ -0,0 +1,85 @@
+import logging
+import select
+import threading
+import time
+
+import psycopg2
+from django.db import connection, OperationalError
+
+logger = logging.getLogger(__name__)
+
+JOBS_CHANNEL = 'doozez_jobs'
+EVENTS_CHANNEL = 'doozez_events'
+
+
+def notify(channel, payload=''):
+    """
+    Sends a NOTIFY on `channel`. Postgres delivers it when the surrounding transaction commits, so listeners
+    only wake up once the new rows are visible to them.
+    """
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [channel, payload])
+
+
+class ExecutableListener(object):
+    """
+    Blocks on LISTEN for `channels` on its own database connection and calls `callback(channel)` once for
+    every channel that was notified. Notifications received while the callback runs are coalesced into a
+    single call. `timeout` bounds how long a single wait blocks so `stop()` is honoured.
+    """
+
+    def __init__(self, channels, callback, timeout=5.0, reconnect_delay=5.0):
+        self.channels = channels
+        self.callback = callback
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self.stopped = threading.Event()
+        self.listening = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='doozez-listener', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def listen(self):
+        connection.ensure_connection()
+        with connection.cursor() as cursor:
+            for channel in self.channels:
+                cursor.execute('LISTEN {}'.format(channel))
+        return connection.connection
+
+    def wait(self, pg_connection):
+        notified = set()
+        if select.select([pg_connection], [], [], self.timeout) != ([], [], []):
+            pg_connection.poll()
+            while pg_connection.notifies:
+                notified.add(pg_connection.notifies.pop(0).channel)
+        return notified
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                try:
+                    pg_connection = self.listen()
+                    self.listening.set()
+                    while not self.stopped.is_set():
+                        for channel in self.wait(pg_connection):
+                            try:
+                                self.callback(channel)
+                            except Exception as ex:
+                                logger.error(ex)
+                except (OperationalError, psycopg2.Error, OSError) as ex:
+                    logger.warning("listener connection lost, reconnecting: {}".format(ex))
+                    self.listening.clear()
+                    connection.close()
+                    time.sleep(self.reconnect_delay)
+        finally:
+            connection.close()
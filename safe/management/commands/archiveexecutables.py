@@ -0,0 +1,30 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...services import RetentionService
+
+
+class Command(BaseCommand):
+    help = "Moves finished jobs, tasks and events into the archive tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.DOOZEZ_RETENTION_DAYS,
+            help="Archive jobs, tasks and events that finished more than this many days ago.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=settings.DOOZEZ_RETENTION_CHUNK_SIZE,
+            help="Number of rows moved per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        retention_service = RetentionService(max_age=datetime.timedelta(days=options["days"]),
+                                             chunk_size=options["chunk_size"])
+        jobs, tasks, events = retention_service.archiveFinished()
+        self.stdout.write("Archived {} jobs, {} tasks without a job and {} events.".format(jobs, tasks, events))
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_databases, teardown_databases
+
+from ...benchmarks import ExecutorBenchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmarks JobExecutor and EventExecutor on a throwaway test database and reports the results as JSON."
+    # like the test runner, system checks run once the test database is set up
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--safes", type=int, default=10, help="Number of safes started.")
+        parser.add_argument("--participants", type=int, default=5, help="Number of participants per safe.")
+        parser.add_argument("--task-pool-size", type=int, default=1, help="Task threads of the JobExecutor.")
+        parser.add_argument("--gateway-latency-ms", type=float, default=0,
+                            help="Simulated round trip of every payment gateway call.")
+        parser.add_argument("--output", help="Write the results to this JSON file instead of stdout.")
+
+    def handle(self, *args, **options):
+        # never seed the configured database, benchmark on a fresh test database like the test runner does
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.check()
+            benchmark = ExecutorBenchmark(safes=options["safes"], participants=options["participants"],
+                                          task_pool_size=options["task_pool_size"],
+                                          gateway_latency=options["gateway_latency_ms"] / 1000)
+            results = benchmark.run()
+        finally:
+            teardown_databases(old_config, verbosity=0)
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                output_file.write(output + "\n")
+        else:
+            self.stdout.write(output)
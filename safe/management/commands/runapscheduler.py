@@ -1,29 +1,101 @@
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from django.conf import settings
 
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from django.core.management.base import BaseCommand
 from django_apscheduler.jobstores import DjangoJobStore
 from django_apscheduler.models import DjangoJobExecution
 from django_apscheduler import util
 
+from ...metrics import push_metrics
+from ...listeners import ExecutableListener, JOBS_CHANNEL, EVENTS_CHANNEL
 from ...tasks import add_tasks
 
-from ...services import JobExecutor, EventExecutor
+from ...services import JobExecutor, EventExecutor, AsyncEventExecutor, LeaseReaper, RetentionService
 
 logger = logging.getLogger(__name__)
 executor = JobExecutor()
-event_executor = EventExecutor()
+event_executor = None
+lease_reaper = LeaseReaper()
+scheduler = None
+worker_pool = None
+worker_count = 1
+
+
+# Every worker runs in its own pool thread and therefore holds its own database connection.
+@util.close_old_connections
+def run_worker(worker):
+    started = time.monotonic()
+    try:
+        executed = worker.executeRunnableJobs(settings.DOOZEZ_EXECUTOR_TICK_MAX_EXECUTIONS,
+                                              settings.DOOZEZ_EXECUTOR_TICK_MAX_SECONDS)
+    except Exception as ex:
+        logger.error(ex)
+        return False
+    # True when the worker stopped on its tick budget rather than on an empty queue
+    return (executed >= settings.DOOZEZ_EXECUTOR_TICK_MAX_EXECUTIONS or
+            time.monotonic() - started >= settings.DOOZEZ_EXECUTOR_TICK_MAX_SECONDS)
+
+
+@util.close_old_connections
+def get_next_run_at(worker):
+    return worker.getNextRunAt()
+
+
+def run_workers(worker, run, wakeup_id):
+    # runs again right away while the workers still leave work behind, NOTIFY only fires for new rows
+    while True:
+        futures = [worker_pool.submit(run_worker, worker) for _ in range(worker_count)]
+        wait(futures)
+        if not any(future.result() for future in futures):
+            break
+    # deferred jobs and events do not notify either, wake up when the earliest of them is due
+    next_run_at = worker_pool.submit(get_next_run_at, worker).result()
+    if next_run_at is not None and scheduler is not None:
+        scheduler.add_job(run, trigger=DateTrigger(run_date=next_run_at), id=wakeup_id, jobstore="wakeups",
+                          replace_existing=True)
 
 
 def run_jobs_in_background():
     logger.info("Running Background Jobs")
+    run_workers(executor, run_jobs_in_background, "wake_jobs")
+
+
+def run_events_in_background():
+    logger.info("Running Background Events")
+    run_workers(event_executor, run_events_in_background, "wake_events")
+
+
+@util.close_old_connections
+def renew_leases():
+    executor.renewLeases()
+    event_executor.renewLeases()
+
+
+@util.close_old_connections
+def reap_expired_leases():
+    lease_reaper.reapExpiredLeases()
+
+
+@util.close_old_connections
+def push_executor_metrics():
     try:
-        executor.executeNextRunnableJob()
+        push_metrics()
     except Exception as ex:
-        logger.error(ex)
+        logger.warning("pushing metrics failed: {}".format(ex))
+
+
+@util.close_old_connections
+def archive_finished_executables():
+    RetentionService().archiveFinished()
 
 
 # The `close_old_connections` decorator ensures that database connections, that have become
@@ -44,18 +116,90 @@ def delete_old_job_executions(max_age=604_800):
 class Command(BaseCommand):
     help = "Runs APScheduler."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.DOOZEZ_EXECUTOR_WORKERS,
+            help="Number of workers claiming jobs and events concurrently.",
+        )
+        parser.add_argument(
+            "--task-processes",
+            type=int,
+            default=settings.DOOZEZ_TASK_PROCESSES,
+            help="Run task functions in this many worker processes instead of threads.",
+        )
+
     def handle(self, *args, **options):
+        global executor, event_executor, scheduler, worker_pool, worker_count
+        worker_count = max(1, options["workers"])
+        if settings.DOOZEZ_ASYNC_EVENTS:
+            # keeps many webhook events in flight per worker while they wait on the payment gateway
+            event_executor = AsyncEventExecutor(os.environ['GC_ACCESS_TOKEN'], os.environ['GC_ENVIRONMENT'])
+        else:
+            event_executor = EventExecutor(os.environ['GC_ACCESS_TOKEN'], os.environ['GC_ENVIRONMENT'])
+        if options["task_processes"] != settings.DOOZEZ_TASK_PROCESSES:
+            executor = JobExecutor(task_processes=options["task_processes"])
+        # job and event workers can run at the same time
+        worker_pool = ThreadPoolExecutor(max_workers=2 * worker_count, thread_name_prefix="doozez-worker")
         add_tasks()
         scheduler = BlockingScheduler(timezone=settings.TIME_ZONE)
         scheduler.add_jobstore(DjangoJobStore(), "default")
+        # one-off wakeups for deferred jobs and events, rescheduled after every drain
+        scheduler.add_jobstore(MemoryJobStore(), "wakeups")
         scheduler.add_job(
             run_jobs_in_background,
-            trigger=CronTrigger(second="*/10"),  # Every 10 seconds
+            trigger=IntervalTrigger(seconds=settings.DOOZEZ_EXECUTOR_POLL_SECONDS),
             id="run_jobs_in_background",  # The `id` assigned to each job MUST be unique
             max_instances=1,
             replace_existing=True,
         )
-        logger.info("Added job 'run_jobs_in_background'.")
+        logger.info("Added job 'run_jobs_in_background' with {} workers.".format(worker_count))
+
+        scheduler.add_job(
+            run_events_in_background,
+            trigger=IntervalTrigger(seconds=settings.DOOZEZ_EXECUTOR_POLL_SECONDS),
+            id="run_events_in_background",
+            max_instances=1,
+            replace_existing=True,
+        )
+        logger.info("Added job 'run_events_in_background' with {} workers.".format(worker_count))
+
+        scheduler.add_job(
+            renew_leases,
+            trigger=IntervalTrigger(seconds=settings.DOOZEZ_HEARTBEAT_SECONDS),
+            id="renew_leases",
+            max_instances=1,
+            replace_existing=True,
+        )
+        scheduler.add_job(
+            reap_expired_leases,
+            trigger=IntervalTrigger(seconds=settings.DOOZEZ_HEARTBEAT_SECONDS),
+            id="reap_expired_leases",
+            max_instances=1,
+            replace_existing=True,
+        )
+        logger.info("Added jobs 'renew_leases' and 'reap_expired_leases', leases expire after {}s.".format(
+            settings.DOOZEZ_LEASE_SECONDS))
+
+        if settings.DOOZEZ_METRICS_PUSHGATEWAY:
+            scheduler.add_job(
+                push_executor_metrics,
+                trigger=IntervalTrigger(seconds=settings.DOOZEZ_METRICS_PUSH_SECONDS),
+                id="push_executor_metrics",
+                max_instances=1,
+                replace_existing=True,
+            )
+            logger.info("Added job 'push_executor_metrics' to {}.".format(settings.DOOZEZ_METRICS_PUSHGATEWAY))
+
+        scheduler.add_job(
+            archive_finished_executables,
+            trigger=CronTrigger(hour="01", minute="00"),  # Daily, outside of business hours.
+            id="archive_finished_executables",
+            max_instances=1,
+            replace_existing=True,
+        )
+        logger.info("Added daily job: 'archive_finished_executables'.")
 
         scheduler.add_job(
             delete_old_job_executions,
@@ -69,10 +213,26 @@ class Command(BaseCommand):
         logger.info(
             "Added weekly job: 'delete_old_job_executions'."
         )
+        listeners = []
+        if settings.DOOZEZ_EXECUTOR_LISTEN:
+            # one listener per queue so a long job drain does not delay webhook events
+            listeners = [
+                ExecutableListener([JOBS_CHANNEL], lambda channel: run_jobs_in_background()),
+                ExecutableListener([EVENTS_CHANNEL], lambda channel: run_events_in_background()),
+            ]
+            for listener in listeners:
+                listener.start()
+            logger.info("Listening for new jobs and events, polling every {}s as fallback.".format(
+                settings.DOOZEZ_EXECUTOR_POLL_SECONDS))
         try:
             logger.info("Starting scheduler...")
             scheduler.start()
         except KeyboardInterrupt:
             logger.info("Stopping scheduler...")
             scheduler.shutdown()
+            for listener in listeners:
+                listener.stop()
+            worker_pool.shutdown()
+            if executor.task_process_pool is not None:
+                executor.task_process_pool.shutdown()
             logger.info("Scheduler shut down successfully!")
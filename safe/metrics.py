@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.utils import timezone
+from prometheus_client import Counter, Histogram, REGISTRY, push_to_gateway
+from prometheus_client.core import GaugeMetricFamily
+
+from .leases import worker_id
+from .models import DoozezJob, DoozezTask, Event, DoozezExecutableStatus, DoozezTaskStatus
+
+TASK_DURATION = Histogram('doozez_task_duration_seconds', 'Time spent running task functions.',
+                          ['task_type'])
+TASK_RUNS = Counter('doozez_task_runs_total', 'Task runs by outcome (success, retry or failure).',
+                    ['task_type', 'outcome'])
+EVENT_DURATION = Histogram('doozez_event_duration_seconds', 'Time spent handling webhook events.',
+                           ['resource_type', 'action'])
+EVENTS_HANDLED = Counter('doozez_events_handled_total', 'Webhook events handled by outcome (success, retry, '
+                                                        'failure or unknown, i.e. no handler).',
+                         ['resource_type', 'action', 'outcome'])
+CLAIM_WAIT = Histogram('doozez_claim_wait_seconds', 'Time from a job, event or task becoming runnable until it '
+                                                    'was claimed.', ['queue'],
+                       buckets=(.05, .1, .5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf')))
+
+
+def task_outcome(task_type, outcome, duration):
+    task_type = getattr(task_type, 'value', task_type)
+    TASK_DURATION.labels(task_type).observe(duration)
+    TASK_RUNS.labels(task_type, outcome).inc()
+
+
+def event_outcome(resource_type, action, outcome, duration):
+    EVENT_DURATION.labels(resource_type, action).observe(duration)
+    EVENTS_HANDLED.labels(resource_type, action, outcome).inc()
+
+
+def claim_waited(queue, runnable):
+    """
+    Records how long a claimed row waited, `runnable` being the later of its creation and its `next_run_at`.
+    """
+    if runnable.next_run_at is not None and runnable.next_run_at > runnable.created_on:
+        since = runnable.next_run_at
+    else:
+        since = runnable.created_on
+    CLAIM_WAIT.labels(queue).observe(max(0.0, (timezone.now() - since).total_seconds()))
+
+
+class QueueDepthCollector(object):
+    """
+    Number of runnable and in-flight jobs, events and tasks per status, counted in the database on every scrape
+    so all web and scheduler processes report the same depth. Finished rows are not counted, each count is
+    answered from the partial index covering its status however many finished rows pile up.
+    """
+    queues = {
+        'job': (DoozezJob.objects, [DoozezExecutableStatus.Created, DoozezExecutableStatus.Running]),
+        'event': (Event.objects, [DoozezExecutableStatus.Created, DoozezExecutableStatus.Running]),
+        'task': (DoozezTask.objects, [DoozezTaskStatus.Pending, DoozezTaskStatus.Running]),
+    }
+
+    def describe(self):
+        # keeps registration from querying the database
+        return [GaugeMetricFamily('doozez_queue_depth', 'Runnable and in-flight jobs, events and tasks by status.',
+                                  labels=['queue', 'status'])]
+
+    def collect(self):
+        depth = GaugeMetricFamily('doozez_queue_depth', 'Runnable and in-flight jobs, events and tasks by status.',
+                                  labels=['queue', 'status'])
+        for queue, (manager, statuses) in self.queues.items():
+            for status in statuses:
+                depth.add_metric([queue, status.value], manager.filter(status=status).count())
+        yield depth
+
+
+REGISTRY.register(QueueDepthCollector())
+
+
+def push_metrics(gateway=None):
+    """
+    Pushes this process' metrics to the Prometheus pushgateway, used by the scheduler whose executors do not
+    serve /metrics themselves.
+    """
+    gateway = gateway or settings.DOOZEZ_METRICS_PUSHGATEWAY
+    if not gateway:
+        return
+    push_to_gateway(gateway, job='doozez-scheduler', registry=REGISTRY, grouping_key={'instance': worker_id()})
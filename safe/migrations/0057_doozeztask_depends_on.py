@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0056_alter_participation_product'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doozeztask',
+            name='depends_on',
+            field=models.ManyToManyField(blank=True, related_name='dependants', to='safe.DoozezTask'),
+        ),
+    ]
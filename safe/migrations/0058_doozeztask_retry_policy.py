@@ -0,0 +1,39 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:04
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0057_doozeztask_depends_on'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doozezjob',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='doozeztask',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='doozeztask',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='doozeztask',
+            name='retry_policy',
+            field=jsonfield.fields.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0059_executable_leases'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='doozezjob',
+            index=models.Index(condition=models.Q(('status__in', ['CRT', 'RNG'])), fields=['-created_on'], name='safe_doozezjob_runnable'),
+        ),
+        migrations.AddIndex(
+            model_name='doozeztask',
+            index=models.Index(condition=models.Q(('status', 'PND')), fields=['job', 'sequence', '-created_on'], name='safe_task_pending'),
+        ),
+        migrations.AddIndex(
+            model_name='doozeztask',
+            index=models.Index(condition=models.Q(('status', 'RUN')), fields=['lease_expires_at'], name='safe_task_leased'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(('status__in', ['CRT', 'RNG'])), fields=['-created_on'], name='safe_event_runnable'),
+        ),
+    ]
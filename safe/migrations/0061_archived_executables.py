@@ -0,0 +1,63 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:09
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0060_executor_claim_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedDoozezJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.PositiveIntegerField(db_index=True)),
+                ('status', models.CharField(choices=[('CRT', 'Created'), ('RNG', 'Running'), ('SUC', 'Success'), ('FLD', 'Failed')], max_length=3)),
+                ('job_type', models.CharField(choices=[('SSF', 'StartSafe')], max_length=3)),
+                ('user_id', models.PositiveIntegerField(null=True)),
+                ('locked_by', models.CharField(blank=True, max_length=200, null=True)),
+                ('created_on', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedDoozezTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.PositiveIntegerField(db_index=True)),
+                ('job_id', models.PositiveIntegerField(db_index=True, null=True)),
+                ('status', models.CharField(choices=[('PND', 'Pending'), ('RUN', 'Running'), ('SUC', 'Success'), ('FLD', 'Failed')], max_length=3)),
+                ('task_type', models.CharField(choices=[('DRW', 'Draw'), ('CTP', 'CreatePayment'), ('CRI', 'CreateInstallments'), ('CSS', 'CompleteSafeStart')], max_length=3)),
+                ('parameters', jsonfield.fields.JSONField(null=True)),
+                ('exceptions', jsonfield.fields.JSONField(null=True)),
+                ('sequence', models.PositiveIntegerField(default=0)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_on', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.PositiveIntegerField(db_index=True)),
+                ('status', models.CharField(choices=[('CRT', 'Created'), ('RNG', 'Running'), ('SUC', 'Success'), ('FLD', 'Failed')], max_length=3)),
+                ('event_id', models.TextField(null=True)),
+                ('resource_type', models.TextField(null=True)),
+                ('action', models.TextField(null=True)),
+                ('link_id', models.TextField(null=True)),
+                ('cause', models.TextField(null=True)),
+                ('description', models.TextField(null=True)),
+                ('gc_created_at', models.TextField(null=True)),
+                ('created_on', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:12
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+# jsonfield stored the hand formatted parameter/exception strings JSON encoded once more, after the cast to jsonb
+# they are JSON strings holding the actual document. Participation ids were formatted as strings as well.
+UNWRAP_JSON_STRINGS = [
+    'UPDATE "{table}" SET "{column}" = ("{column}" #>> \'{{}}\')::jsonb WHERE jsonb_typeof("{column}") = \'string\''
+    .format(table=table, column=column)
+    for table in ['safe_doozeztask', 'safe_archiveddoozeztask']
+    for column in ['parameters', 'exceptions']
+] + [
+    'UPDATE "{table}" SET "parameters" = jsonb_set("parameters", \'{{participation_id}}\', '
+    'to_jsonb(("parameters" ->> \'participation_id\')::integer)) '
+    'WHERE jsonb_typeof("parameters" -> \'participation_id\') = \'string\''.format(table=table)
+    for table in ['safe_doozeztask', 'safe_archiveddoozeztask']
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0061_archived_executables'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archiveddoozeztask',
+            name='exceptions',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='archiveddoozeztask',
+            name='parameters',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='doozeztask',
+            name='exceptions',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='doozeztask',
+            name='parameters',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunSQL(UNWRAP_JSON_STRINGS, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='doozeztask',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['parameters'], name='safe_task_parameters', opclasses=['jsonb_path_ops']),
+        ),
+    ]
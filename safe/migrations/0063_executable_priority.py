@@ -0,0 +1,52 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0062_task_parameters_jsonb'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='doozezjob',
+            name='safe_doozezjob_runnable',
+        ),
+        migrations.RemoveIndex(
+            model_name='doozeztask',
+            name='safe_task_pending',
+        ),
+        migrations.RemoveIndex(
+            model_name='event',
+            name='safe_event_runnable',
+        ),
+        migrations.AddField(
+            model_name='doozezjob',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Low'), (1, 'Normal'), (2, 'High')], default=1),
+        ),
+        migrations.AddField(
+            model_name='doozeztask',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Low'), (1, 'Normal'), (2, 'High')], default=1),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Low'), (1, 'Normal'), (2, 'High')], default=1),
+        ),
+        migrations.AddIndex(
+            model_name='doozezjob',
+            index=models.Index(condition=models.Q(('status__in', ['CRT', 'RNG'])), fields=['priority', 'created_on'], name='safe_doozezjob_runnable'),
+        ),
+        migrations.AddIndex(
+            model_name='doozeztask',
+            index=models.Index(condition=models.Q(('status', 'PND')), fields=['job', '-priority', 'sequence', '-created_on'], name='safe_task_pending'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(('status__in', ['CRT', 'RNG'])), fields=['priority', 'created_on'], name='safe_event_runnable'),
+        ),
+    ]
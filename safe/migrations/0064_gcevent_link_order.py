@@ -0,0 +1,17 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0063_executable_priority'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gcevent',
+            index=models.Index(fields=['link_id', 'gc_created_at'], name='safe_gcevent_link'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:29
+
+from django.db import migrations, models
+
+# redelivered webhooks were stored again, only the first copy of each gc event (and its executor event) is kept
+DELETE_DUPLICATE_EVENTS = [
+    'DELETE FROM "safe_event" WHERE "gc_event_id" IN (SELECT "id" FROM "safe_gcevent" AS duplicate WHERE EXISTS '
+    '(SELECT 1 FROM "safe_gcevent" AS first WHERE first."event_id" = duplicate."event_id" AND first."id" < '
+    'duplicate."id"))',
+    'DELETE FROM "safe_gcevent" AS duplicate WHERE EXISTS (SELECT 1 FROM "safe_gcevent" AS first WHERE '
+    'first."event_id" = duplicate."event_id" AND first."id" < duplicate."id")',
+    # safe_event's foreign key is deferred, its checks of the deletes above must run before safe_gcevent can be
+    # altered in the same transaction
+    'SET CONSTRAINTS ALL IMMEDIATE',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0064_gcevent_link_order'),
+    ]
+
+    operations = [
+        migrations.RunSQL(DELETE_DUPLICATE_EVENTS, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='gcevent',
+            name='event_id',
+            field=models.TextField(unique=True),
+        ),
+    ]
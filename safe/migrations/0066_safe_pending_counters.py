@@ -0,0 +1,35 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:33
+
+from django.db import migrations, models
+
+# counts what SafeService.poke used to query for every poke
+COUNT_PENDING = (
+    'UPDATE "safe_safe" SET '
+    '"pending_payments" = (SELECT COUNT(*) FROM "safe_payment" INNER JOIN "safe_participation" ON '
+    '"safe_payment"."participation_id" = "safe_participation"."id" WHERE "safe_participation"."safe_id" = '
+    '"safe_safe"."id" AND "safe_payment"."status" IN (\'pending_submission\', \'submitted\')), '
+    '"pending_instalments" = (SELECT COUNT(*) FROM "safe_instalment" INNER JOIN "safe_participation" ON '
+    '"safe_instalment"."participation_id" = "safe_participation"."id" WHERE "safe_participation"."safe_id" = '
+    '"safe_safe"."id" AND "safe_instalment"."status" <> \'active\')'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0065_unique_gcevent_event_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='safe',
+            name='pending_instalments',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='safe',
+            name='pending_payments',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunSQL(COUNT_PENDING, migrations.RunSQL.noop),
+    ]
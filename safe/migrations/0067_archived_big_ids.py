@@ -0,0 +1,38 @@
+# Generated by Django 3.2.4 on 2026-10-17 04:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0066_safe_pending_counters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archiveddoozezjob',
+            name='original_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='archiveddoozezjob',
+            name='user_id',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='archiveddoozeztask',
+            name='job_id',
+            field=models.BigIntegerField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='archiveddoozeztask',
+            name='original_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='archivedevent',
+            name='original_id',
+            field=models.BigIntegerField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-17 05:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('safe', '0067_archived_big_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='doozeztask',
+            name='retry_policy',
+            field=models.JSONField(null=True),
+        ),
+    ]
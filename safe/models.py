@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
 from djmoney.models.fields import MoneyField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
 from django.core.validators import MinValueValidator
 from django.utils.translation import ugettext_lazy as _
@@ -59,12 +60,22 @@ class DoozezExecutableStatus(models.TextChoices):
     Failed = 'FLD', _('Failed')
 
 
+class DoozezPriority(models.IntegerChoices):
+    Low = 0, _('Low')
+    Normal = 1, _('Normal')
+    High = 2, _('High')
+
+
 class DoozezExecutable(TimeStampedModel):
     status = FSMField(
         choices=DoozezExecutableStatus.choices,
         default=DoozezExecutableStatus.Created,
         protected=True,
     )
+    priority = models.PositiveSmallIntegerField(choices=DoozezPriority.choices, default=DoozezPriority.Normal)
+    next_run_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=200, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
 
     @transition(field=status, source=[DoozezExecutableStatus.Created, DoozezExecutableStatus.Running],
                 target=DoozezExecutableStatus.Running)
@@ -83,6 +94,12 @@ class DoozezExecutable(TimeStampedModel):
 
     class Meta:
         abstract = True
+        # only claimable rows are indexed so claims stay fast however many finished rows pile up
+        indexes = [
+            models.Index(fields=['priority', 'created_on'], name='%(app_label)s_%(class)s_runnable',
+                         condition=models.Q(status__in=[DoozezExecutableStatus.Created,
+                                                        DoozezExecutableStatus.Running])),
+        ]
 
 
 class DoozezJobStatus(models.TextChoices):
@@ -128,10 +145,17 @@ class DoozezTask(TimeStampedModel):
         max_length=3,
         choices=DoozezTaskType.choices
     )
-    parameters = JSONField(null=True)
-    exceptions = JSONField(null=True)
+    parameters = models.JSONField(null=True)
+    exceptions = models.JSONField(null=True)
     job = models.ForeignKey(DoozezJob, on_delete=models.CASCADE, related_name='jobs_tasks', null=True)
     sequence = models.PositiveIntegerField(default=0)
+    priority = models.PositiveSmallIntegerField(choices=DoozezPriority.choices, default=DoozezPriority.Normal)
+    depends_on = models.ManyToManyField('self', symmetrical=False, related_name='dependants', blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    retry_policy = models.JSONField(null=True)
+    next_run_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=200, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
 
     @transition(field=status, source=[DoozezTaskStatus.Pending],
                 target=DoozezTaskStatus.Running)
@@ -148,12 +172,28 @@ class DoozezTask(TimeStampedModel):
     def finishWithFailure(self):
         pass
 
+    @transition(field=status, source=[DoozezTaskStatus.Running],
+                target=DoozezTaskStatus.Pending)
+    def scheduleRetry(self):
+        pass
+
     def __str__(self):
         return '%d, %s: status: %s, exceptions: %s' % (self.id, self.get_task_type_display(), self.get_status_display(), self.exceptions)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['job', '-priority', 'sequence', '-created_on'], name='safe_task_pending',
+                         condition=models.Q(status=DoozezTaskStatus.Pending)),
+            models.Index(fields=['lease_expires_at'], name='safe_task_leased',
+                         condition=models.Q(status=DoozezTaskStatus.Running)),
+            # containment lookups, e.g. parameters__contains={'participation_id': 1}
+            GinIndex(fields=['parameters'], name='safe_task_parameters', opclasses=['jsonb_path_ops']),
+        ]
+
 
 class GCEvent(models.Model):
-    event_id = models.TextField()
+    # the gateway redelivers webhooks, its event id keeps every event in here once
+    event_id = models.TextField(unique=True)
     resource_type = models.TextField()
     action = models.TextField()
     link_id = models.TextField(null=True)
@@ -161,11 +201,59 @@ class GCEvent(models.Model):
     description = models.TextField(null=True)
     gc_created_at = models.TextField(null=True)
 
+    class Meta:
+        indexes = [
+            # events of a link in creation order, see EventService.getOrderedPendingExecutable
+            models.Index(fields=['link_id', 'gc_created_at'], name='safe_gcevent_link'),
+        ]
+
 
 class Event(DoozezExecutable):
     gc_event = models.ForeignKey(GCEvent, on_delete=models.CASCADE, related_name='%(class)s_user', null=True)
 
 
+# Finished jobs, tasks and events are moved into the archive tables below by RetentionService, which keeps the
+# tables the executors claim from small. Archived rows keep their original ids but no foreign keys.
+class ArchivedDoozezJob(models.Model):
+    original_id = models.BigIntegerField(db_index=True)
+    status = models.CharField(max_length=3, choices=DoozezExecutableStatus.choices)
+    job_type = models.CharField(max_length=3, choices=DoozezJobType.choices)
+    user_id = models.BigIntegerField(null=True)
+    locked_by = models.CharField(max_length=200, null=True, blank=True)
+    created_on = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_on = models.DateTimeField(auto_now_add=True)
+
+
+class ArchivedDoozezTask(models.Model):
+    original_id = models.BigIntegerField(db_index=True)
+    job_id = models.BigIntegerField(null=True, db_index=True)
+    status = models.CharField(max_length=3, choices=DoozezTaskStatus.choices)
+    task_type = models.CharField(max_length=3, choices=DoozezTaskType.choices)
+    parameters = models.JSONField(null=True)
+    exceptions = models.JSONField(null=True)
+    sequence = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    created_on = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_on = models.DateTimeField(auto_now_add=True)
+
+
+class ArchivedEvent(models.Model):
+    original_id = models.BigIntegerField(db_index=True)
+    status = models.CharField(max_length=3, choices=DoozezExecutableStatus.choices)
+    event_id = models.TextField(null=True)
+    resource_type = models.TextField(null=True)
+    action = models.TextField(null=True)
+    link_id = models.TextField(null=True)
+    cause = models.TextField(null=True)
+    description = models.TextField(null=True)
+    gc_created_at = models.TextField(null=True)
+    created_on = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_on = models.DateTimeField(auto_now_add=True)
+
+
 class MandateStatus(models.TextChoices):
     PendingCustomerApproval = 'pending_customer_approval', _('pending_customer_approval')
     Created = 'created', _('Created')
@@ -269,6 +357,9 @@ class Safe(models.Model):
     total_participants = models.PositiveIntegerField(default=0)
     initiator = models.ForeignKey(DoozezUser, on_delete=models.CASCADE, related_name='initiator', null=True)
     job = models.ForeignKey(DoozezJob, on_delete=models.DO_NOTHING, null=True, blank=True)
+    # payments awaiting confirmation and instalments awaiting activation, the safe is started once both are 0
+    pending_payments = models.PositiveIntegerField(default=0)
+    pending_instalments = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -0,0 +1,73 @@
+import threading
+
+from django.conf import settings
+
+from .models import DoozezPriority, DoozezJobType, DoozezTaskType
+
+PRIORITY_WEIGHTS = {
+    DoozezPriority.High.value: 4,
+    DoozezPriority.Normal.value: 2,
+    DoozezPriority.Low.value: 1,
+}
+
+JOB_PRIORITIES = {
+    DoozezJobType.StartSafe.value: DoozezPriority.Normal.value,
+}
+
+TASK_PRIORITIES = {
+    DoozezTaskType.Draw.value: DoozezPriority.Normal.value,
+    DoozezTaskType.CreatePayment.value: DoozezPriority.Normal.value,
+    DoozezTaskType.CreateInstallments.value: DoozezPriority.Normal.value,
+    DoozezTaskType.CompleteSafeStart.value: DoozezPriority.Normal.value,
+}
+
+
+def get_priority_weights():
+    """
+    Share of claims each priority level gets while all levels have work, overridable with
+    `DOOZEZ_PRIORITY_WEIGHTS` in settings.
+    """
+    return {**PRIORITY_WEIGHTS, **settings.DOOZEZ_PRIORITY_WEIGHTS}
+
+
+def get_job_priority(job_type):
+    job_type = getattr(job_type, 'value', job_type)
+    return settings.DOOZEZ_JOB_PRIORITIES.get(job_type, JOB_PRIORITIES.get(job_type, DoozezPriority.Normal.value))
+
+
+def get_task_priority(task_type):
+    task_type = getattr(task_type, 'value', task_type)
+    return settings.DOOZEZ_TASK_PRIORITIES.get(task_type, TASK_PRIORITIES.get(task_type, DoozezPriority.Normal.value))
+
+
+class WeightedFairScheduler(object):
+    """
+    Smooth weighted round robin over priority levels. Every claim each level earns its weight in credit and the
+    level with the most credit is tried first; the level a claim is served from pays back the weights of the
+    levels that were not found idle. While all levels have work they are served in proportion to their weights,
+    so a burst on one level delays the others by a bounded number of claims instead of starving them. Idle
+    levels do not bank credit, and a level that is the only busy one does not run into debt either, credits
+    stay within [-total, total].
+    """
+
+    def __init__(self, weights):
+        self.weights = dict(weights)
+        self.total = sum(self.weights.values())
+        self.credits = {level: 0 for level in self.weights}
+        self.lock = threading.Lock()
+
+    def claim_order(self):
+        with self.lock:
+            for level, weight in self.weights.items():
+                self.credits[level] = min(self.total, self.credits[level] + weight)
+            return sorted(self.credits, key=lambda level: (self.credits[level], level), reverse=True)
+
+    def charge(self, level, idle=()):
+        # `idle` are the levels found without work while looking for this claim, their weight was not earned
+        with self.lock:
+            busy = self.total - sum(self.weights[idle_level] for idle_level in idle)
+            self.credits[level] = max(-self.total, self.credits[level] - busy)
+
+    def idle(self, level):
+        with self.lock:
+            self.credits[level] = 0
@@ -0,0 +1,81 @@
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Worker processes are spawned, not forked, so they never share the scheduler's database sockets. They import
+# this module before Django is set up, Django is therefore only imported inside the functions below.
+
+
+class TaskProcessError(Exception):
+    pass
+
+
+def init_worker(database_name, initializer):
+    import django
+    from django.conf import settings
+    from django.utils.module_loading import import_string
+
+    django.setup()
+    # the worker uses the database of the scheduler that spawned it, e.g. the test database
+    settings.DATABASES['default']['NAME'] = database_name
+    if initializer:
+        import_string(initializer)()
+
+
+def execute_task(task_id):
+    """
+    Runs the function of a task in a worker process and returns its exceptions (None on success) together
+    with whether the exception is retryable. The scheduler, which counted the attempt when claiming the task,
+    decides on the retry and records the outcome on the task.
+    """
+    from django.db import transaction
+
+    from .decorators import run
+    from .models import DoozezTask
+    from .retry import RetryPolicy
+    from .utils import exception_as_dict
+
+    task = DoozezTask.objects.get(pk=task_id)
+    try:
+        with transaction.atomic():
+            run(task.task_type, **task.parameters)
+        return None, False
+    except Exception as ex:
+        return exception_as_dict(ex, sys.exc_info()), RetryPolicy.from_dict(task.retry_policy).is_retryable(ex)
+
+
+class TaskProcessPool(object):
+    """
+    Pool of worker processes running task functions outside of the scheduler, each with its own database
+    connection and payment gateway client. `initializer` is the dotted path of a function registering the task
+    functions in the workers, by default the scheduler's `add_tasks`. A broken pool, e.g. after a worker
+    crashed, is replaced on the next submit.
+    """
+
+    def __init__(self, size, initializer='safe.tasks.add_tasks'):
+        self.size = size
+        self.initializer = initializer
+        self.pool = None
+
+    def getPool(self):
+        if self.pool is None:
+            from django.db import connection
+
+            self.pool = ProcessPoolExecutor(max_workers=self.size,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=init_worker,
+                                            initargs=(connection.settings_dict['NAME'], self.initializer))
+        return self.pool
+
+    def submit(self, task_id):
+        return self.getPool().submit(execute_task, task_id)
+
+    def reset(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
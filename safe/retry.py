@@ -0,0 +1,91 @@
+import random
+
+from django.conf import settings
+
+from .models import DoozezTaskType
+
+GATEWAY_TRANSIENT_ERRORS = [
+    'gocardless_pro.errors.GoCardlessInternalError',
+    'gocardless_pro.errors.MalformedResponseError',
+    'requests.exceptions.ConnectionError',
+    'requests.exceptions.Timeout',
+]
+# rate limited (429) and 5xx responses are retried whatever the gateway error class is
+GATEWAY_TRANSIENT_CODES = [429, 500, 502, 503, 504]
+
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed task is retried and when. A task is retried while it has attempts left and the
+    exception (or one of its base classes) is listed in `retryable`, given as dotted class paths, or carries a
+    `code` listed in `retryable_codes`. The n-th retry waits base_delay * 2^(n-1) seconds, capped at max_delay,
+    of which up to `jitter` (a fraction) is randomly taken off so retries of a burst do not line up.
+    """
+    max_attempts = 1
+    base_delay = 1.0
+    max_delay = 300.0
+    jitter = 0.5
+    retryable = []
+    retryable_codes = []
+
+    def __init__(self, max_attempts=1, base_delay=1.0, max_delay=300.0, jitter=0.5, retryable=None,
+                 retryable_codes=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retryable = list(retryable or [])
+        self.retryable_codes = list(retryable_codes or [])
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return cls()
+        return cls(**data)
+
+    def to_dict(self):
+        return dict(max_attempts=self.max_attempts,
+                    base_delay=self.base_delay,
+                    max_delay=self.max_delay,
+                    jitter=self.jitter,
+                    retryable=self.retryable,
+                    retryable_codes=self.retryable_codes)
+
+    def is_retryable(self, ex):
+        class_paths = ['{}.{}'.format(c.__module__, c.__qualname__) for c in type(ex).__mro__]
+        if any(path in self.retryable for path in class_paths):
+            return True
+        return getattr(ex, 'code', None) in self.retryable_codes
+
+    def has_attempts_left(self, attempts):
+        return attempts < self.max_attempts
+
+    def should_retry(self, attempts, ex):
+        return self.has_attempts_left(attempts) and self.is_retryable(ex)
+
+    def next_delay(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay - random.uniform(0, self.jitter * delay)
+
+
+RETRY_POLICIES = {
+    DoozezTaskType.CreatePayment.value: RetryPolicy(max_attempts=5, base_delay=2.0, max_delay=300.0, jitter=0.5,
+                                                    retryable=GATEWAY_TRANSIENT_ERRORS,
+                                                    retryable_codes=GATEWAY_TRANSIENT_CODES),
+    DoozezTaskType.CreateInstallments.value: RetryPolicy(max_attempts=5, base_delay=2.0, max_delay=300.0,
+                                                         jitter=0.5, retryable=GATEWAY_TRANSIENT_ERRORS,
+                                                         retryable_codes=GATEWAY_TRANSIENT_CODES),
+}
+
+
+def get_retry_policy(task_type):
+    """
+    Retry policy for a task type. `DOOZEZ_TASK_RETRY_POLICIES` in settings overrides the defaults above with
+    a dict of RetryPolicy arguments per task type value, e.g. {'CTP': {'max_attempts': 8}}.
+    """
+    task_type = getattr(task_type, 'value', task_type)
+    policy = RETRY_POLICIES.get(task_type, RetryPolicy())
+    overrides = settings.DOOZEZ_TASK_RETRY_POLICIES.get(task_type)
+    if overrides:
+        policy = RetryPolicy.from_dict({**policy.to_dict(), **overrides})
+    return policy
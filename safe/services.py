@@ -1,29 +1,49 @@
+import asyncio
 import datetime
-import json
+import functools
+import itertools
 import logging
 import sys
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from typing import Union
 
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import transaction
+from django.db import connection, transaction
+from django.utils import timezone
 from djmoney.money import Money
+from psycopg2.extras import execute_values
 
-from .client_interfaces import PaymentGatewayClient
+from .client_interfaces import PaymentGatewayClient, AsyncPaymentGatewayClient
 from .models import Invitation, Safe, InvitationStatus, Participation, PaymentMethod, \
     ParticipantRole, GCFlow, Mandate, DoozezTask, DoozezTaskStatus, ParticipationStatus, SafeStatus, PaymentStatus, \
     Payment, DoozezTaskType, DoozezJob, DoozezJobType, GCEvent, Event, DoozezExecutableStatus, DoozezUser, Instalment, \
-    InstalmentStatus, Product
-from .decorators import run
+    InstalmentStatus, Product, ArchivedDoozezJob, ArchivedDoozezTask, ArchivedEvent
+from .decorators import run, doozez_event_handler, event_handler_name
+from .gateway_cache import evict
+from .leases import worker_id, lease_expiry
+from .listeners import notify, JOBS_CHANNEL, EVENTS_CHANNEL
+from .metrics import task_outcome, event_outcome, claim_waited
+from .process_pool import TaskProcessPool, TaskProcessError
+from .priorities import get_priority_weights, get_job_priority, get_task_priority, WeightedFairScheduler
+from .retry import get_retry_policy, RetryPolicy
 
 from django.core.exceptions import ValidationError
-from django.db.models import Q
+from django.db.models import Q, Exists, OuterRef, F
+from django.db.models.functions import Greatest
 
 from .utils import exception_as_dict, send_notification_to_user_from_template
 
 
+# the gateway is still creating what a webhook event announced, the event is handled again later
+class ResourceNotReadyError(Exception):
+    pass
+
+
 class EventType(Enum):
     InvitationCreated = 1
 
@@ -311,6 +331,10 @@ class PaymentService(object):
         else:
             self.payment_gate_way_client = PaymentGatewayClient(access_token, environment)
 
+    def getPaymentIdempotencyKey(self, participation):
+        # a safe charges each participation once when it starts, so retries and re-runs reuse the same payment
+        return "safe-{}-participation-{}-payment".format(participation.safe_id, participation.pk)
+
     def createPayment(self, participation_id, amount, currency, description):
         participation = self.participation_service.getParticipationWithId(participation_id)
         if participation is None:
@@ -318,7 +342,8 @@ class PaymentService(object):
         external_payment = self.payment_gate_way_client.create_payment(
             participation.payment_method.mandate.mandate_external_id,
             amount,
-            currency)
+            currency,
+            self.getPaymentIdempotencyKey(participation))
         refreshed_external_payment = self.payment_gate_way_client.get_payment(external_payment.id)
         if refreshed_external_payment.status == 'cancelled':
             raise ValidationError("payment with external-id {} was cancelled immediately".format(external_payment.id))
@@ -327,6 +352,7 @@ class PaymentService(object):
                                          description=description,
                                          charge_date=refreshed_external_payment.charge_date,
                                          external_id=external_payment.id)
+        self.updatePendingCountersForSafe(participation.safe_id, payments=1)
         return payment
 
     def createInternalPayment(self, participation, amount, currency, description, charge_date, external_id):
@@ -337,6 +363,12 @@ class PaymentService(object):
                                          external_id=external_id)
         return payment
 
+    def updatePendingCountersForSafe(self, safe_id, payments=0, instalments=0):
+        # atomic in the database, so concurrent confirmations of one safe do not lose updates
+        return Safe.objects.filter(pk=safe_id).update(
+            pending_payments=Greatest(F('pending_payments') + payments, 0),
+            pending_instalments=Greatest(F('pending_instalments') + instalments, 0))
+
     def getPendingConfirmationPaymentsForSafe(self, safe_id):
         result = Payment.objects.filter(
             Q(participation__safe=safe_id) &
@@ -353,70 +385,184 @@ class PaymentService(object):
         payment = Payment.objects.get(pk=payment_id)
         if payment is None:
             raise ValidationError("payment not found for {}".format(str(payment_id)))
-        payment.paymentConfirmed()
-        payment.save()
+        with transaction.atomic():
+            payment.paymentConfirmed()
+            payment.save()
+            self.updatePendingCountersForSafe(payment.participation.safe_id, payments=-1)
         return payment
 
 
 class TaskService(object):
+    logger = logging.getLogger(__name__)
 
     def __init__(self):
-        pass
-
-    def createTaskForJob(self, task_type, parameters, sequence, job):
-        return DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=task_type,
-                                         parameters=parameters, job=job, sequence=sequence)
-
-    def getTasksWithConcurrencyWithQ(self, query):
-        return DoozezTask.objects.select_for_update().filter(query)
+        # tasks this process is running, their leases are renewed by renewTaskLeases
+        self.leased_tasks = set()
+        self.leased_tasks_lock = threading.Lock()
+
+    def createTaskForJob(self, task_type, parameters, sequence, job, depends_on=None):
+        task = DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=task_type,
+                                         parameters=parameters, job=job, sequence=sequence,
+                                         priority=get_task_priority(task_type),
+                                         retry_policy=get_retry_policy(task_type).to_dict())
+        if depends_on:
+            task.depends_on.set(depends_on)
+        return task
+
+    def getTasksWithConcurrencyWithQ(self, query, skip_locked=False):
+        return DoozezTask.objects.select_for_update(skip_locked=skip_locked).filter(query)
 
     def getOrderedPendingTasksForJob(self, job_id):
-        return self.getTasksWithConcurrencyWithQ(Q(status=DoozezTaskStatus.Pending) & Q(job=job_id)).order_by(
-            'sequence', '-created_on')
+        # tasks still waiting on an unfinished dependency or a retry backoff are not runnable yet
+        return self.getTasksWithConcurrencyWithQ(Q(status=DoozezTaskStatus.Pending) & Q(job=job_id) &
+                                                 (Q(next_run_at__isnull=True) | Q(next_run_at__lte=timezone.now())),
+                                                 skip_locked=True).exclude(
+            depends_on__status__in=[DoozezTaskStatus.Pending, DoozezTaskStatus.Running, DoozezTaskStatus.Failed]
+        ).order_by('-priority', 'sequence', '-created_on')
+
+    def getTasksForParticipation(self, participation_id):
+        return DoozezTask.objects.filter(parameters__contains={'participation_id': participation_id})
 
     def getNextRunableTask(self, job_id):
         return self.getOrderedPendingTasksForJob(job_id).first()
 
-    def runNextRunnableTask(self, job_id):
-        task = None
+    def hasUnfinishedTasksForJob(self, job_id):
+        return DoozezTask.objects.filter(Q(job=job_id) & (Q(status=DoozezTaskStatus.Pending) |
+                                                          Q(status=DoozezTaskStatus.Running))).exists()
+
+    def getNextRetryForJob(self, job_id):
+        task = DoozezTask.objects.filter(Q(job=job_id) & Q(status=DoozezTaskStatus.Pending) &
+                                         Q(next_run_at__isnull=False)).order_by('next_run_at').first()
+        return None if task is None else task.next_run_at
+
+    def claimNextRunnableTask(self, job_id):
         with transaction.atomic():
             task = self.getNextRunableTask(job_id)
             if task is None:
                 return
+            claim_waited('task', task)
+            task.attempts += 1
+            task.locked_by = worker_id()
+            task.lease_expires_at = lease_expiry()
             task.startRunning()
             task.save()
+        with self.leased_tasks_lock:
+            self.leased_tasks.add(task.pk)
+        return task
+
+    def releaseTaskLease(self, task):
+        task.lease_expires_at = None
+        with self.leased_tasks_lock:
+            self.leased_tasks.discard(task.pk)
+
+    def renewTaskLeases(self):
+        with self.leased_tasks_lock:
+            task_ids = list(self.leased_tasks)
+        if not task_ids:
+            return 0
+        return DoozezTask.objects.filter(pk__in=task_ids, status=DoozezTaskStatus.Running,
+                                         locked_by=worker_id()).update(lease_expires_at=lease_expiry())
+
+    def reapExpiredTaskLeases(self):
+        # returns the ids of the jobs whose tasks went back to Pending
+        with transaction.atomic():
+            expired = list(self.getTasksWithConcurrencyWithQ(Q(status=DoozezTaskStatus.Running) &
+                                                             Q(lease_expires_at__lt=timezone.now()),
+                                                             skip_locked=True).values_list('pk', 'job'))
+            if not expired:
+                return set()
+            DoozezTask.objects.filter(pk__in=[task_id for task_id, job_id in expired]).update(
+                status=DoozezTaskStatus.Pending, locked_by=None, lease_expires_at=None)
+        self.logger.warning("reclaimed {} tasks with an expired lease".format(len(expired)))
+        return {job_id for task_id, job_id in expired if job_id is not None}
+
+    def runTask(self, task):
+        started = time.monotonic()
         try:
-            run(task.task_type, **json.loads(task.parameters))
+            # a failing task only rolls back its own writes, its claim is already committed
+            with transaction.atomic():
+                run(task.task_type, **task.parameters)
+        except Exception as ex:
+            err = sys.exc_info()
+            policy = RetryPolicy.from_dict(task.retry_policy)
+            self.recordTaskResult(task, exception_as_dict(ex, err), policy.should_retry(task.attempts, ex),
+                                  time.monotonic() - started)
+            if task.status == DoozezTaskStatus.Failed:
+                raise ex
+            return task
+        return self.recordTaskResult(task, duration=time.monotonic() - started)
+
+    def recordTaskResult(self, task, exceptions=None, retry=False, duration=0.0):
+        self.releaseTaskLease(task)
+        if exceptions is None:
             task.finishSuccessfully()
             task.save()
+            task_outcome(task.task_type, 'success', duration)
             return task
-        except Exception as ex:
-            err = sys.exc_info()
-            task.exceptions = json.dumps(exception_as_dict(ex, err))
+        task.exceptions = exceptions
+        if retry:
+            # transient failure, the task is picked up again once its backoff has passed
+            policy = RetryPolicy.from_dict(task.retry_policy)
+            task.next_run_at = timezone.now() + datetime.timedelta(seconds=policy.next_delay(task.attempts))
+            task.scheduleRetry()
+        else:
             task.finishWithFailure()
-            task.save()
-            raise ex
+        task.save()
+        task_outcome(task.task_type, 'retry' if retry else 'failure', duration)
+        return task
+
+    def runNextRunnableTask(self, job_id):
+        task = self.claimNextRunnableTask(job_id)
+        if task is None:
+            return
+        return self.runTask(task)
 
 
 class ExecutableService(object):
+    channel = None
+    queue = None
 
     def __init__(self):
-        pass
+        self.priority_scheduler = WeightedFairScheduler(get_priority_weights())
+        # executables this process claimed and is still working on, their leases are renewed by renewLeases
+        self.leased = set()
+        self.leased_lock = threading.Lock()
 
     def get_query_set(self):
         pass
 
-    def getExecutableWithConcurrencyWithQ(self, query):
-        result = self.get_query_set().select_for_update().filter(query)
+    def notifyExecutableCreated(self):
+        # wakes up schedulers blocked on LISTEN once the creating transaction commits
+        notify(self.channel)
+
+    def getExecutableWithConcurrencyWithQ(self, query, skip_locked=False):
+        # only the executable rows are locked, not the rows joined in to filter or order them
+        result = self.get_query_set().select_for_update(skip_locked=skip_locked, of=('self',)).filter(query)
         return result
 
-    def getOrderedPendingExecutable(self):
-        return self.getExecutableWithConcurrencyWithQ(Q(status=DoozezExecutableStatus.Created)
-                                                      | Q(status=DoozezExecutableStatus.Running)).order_by(
-            '-created_on')
+    def getOrderedPendingExecutable(self, priority=None):
+        # rows locked by other workers are skipped so each worker claims a different executable,
+        # Running ones are only picked up again once their lease is released or expired
+        now = timezone.now()
+        query = (Q(status=DoozezExecutableStatus.Created) |
+                 (Q(status=DoozezExecutableStatus.Running) &
+                  (Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lte=now)))) & \
+                (Q(next_run_at__isnull=True) | Q(next_run_at__lte=now))
+        if priority is not None:
+            query &= Q(priority=priority)
+        return self.getExecutableWithConcurrencyWithQ(query, skip_locked=True).order_by('created_on')
 
     def getNextExecutable(self):
-        return self.getOrderedPendingExecutable().first()
+        # priority levels are served weighted fair, oldest first within a level
+        idle = []
+        for priority in self.priority_scheduler.claim_order():
+            executable = self.getOrderedPendingExecutable(priority).first()
+            if executable is not None:
+                self.priority_scheduler.charge(priority, idle)
+                return executable
+            self.priority_scheduler.idle(priority)
+            idle.append(priority)
+        return None
 
     def runNextExecutable(self):
         executable = None
@@ -424,24 +570,94 @@ class ExecutableService(object):
             executable = self.getNextExecutable()
             if executable is None:
                 return
+            if executable.status == DoozezExecutableStatus.Created:
+                # a job is re-claimed after each round of tasks, only its first claim waited in the queue
+                claim_waited(self.queue, executable)
+            executable.locked_by = worker_id()
+            executable.lease_expires_at = lease_expiry()
             executable.startRunning()
             executable.save()
+        # the claim is committed, from here on the lease rather than a row lock keeps other workers off it
+        self.holdLeases([executable.pk])
         return executable
 
+    def holdLeases(self, exec_ids):
+        with self.leased_lock:
+            self.leased.update(exec_ids)
+
+    def dropLeases(self, exec_ids):
+        with self.leased_lock:
+            self.leased.difference_update(exec_ids)
+
+    def renewLeases(self):
+        with self.leased_lock:
+            exec_ids = list(self.leased)
+        if not exec_ids:
+            return 0
+        return self.get_query_set().filter(pk__in=exec_ids, status=DoozezExecutableStatus.Running,
+                                           locked_by=worker_id()).update(lease_expires_at=lease_expiry())
+
     def finishExecutableSuccefully(self, exec_id):
         with transaction.atomic():
             executable = self.getExecutableWithConcurrencyWithQ(Q(pk=exec_id)).first()
             executable.finishSuccessfully()
+            executable.lease_expires_at = None
             executable.save()
+        self.dropLeases([exec_id])
 
     def finishExecutableWithFailure(self, exec_id):
         with transaction.atomic():
             executable = self.getExecutableWithConcurrencyWithQ(Q(pk=exec_id)).first()
             executable.finishWithFailure()
+            executable.lease_expires_at = None
             executable.save()
+        self.dropLeases([exec_id])
+
+    def finishExecutables(self, exec_ids, status):
+        # one UPDATE for executables handled together
+        finished = self.get_query_set().filter(pk__in=exec_ids).update(status=status, lease_expires_at=None,
+                                                                       updated_at=timezone.now())
+        self.dropLeases(exec_ids)
+        return finished
+
+    def deferExecutable(self, exec_id, next_run_at):
+        self.deferExecutables([exec_id], next_run_at)
+
+    def deferExecutables(self, exec_ids, next_run_at):
+        self.get_query_set().filter(pk__in=exec_ids).update(next_run_at=next_run_at, lease_expires_at=None)
+        self.dropLeases(exec_ids)
+
+    def getNextRunAt(self):
+        # when the earliest deferred executable becomes runnable, None when none is waiting
+        executable = self.get_query_set().filter(status=DoozezExecutableStatus.Created,
+                                                 next_run_at__gt=timezone.now()).order_by('next_run_at').first()
+        return None if executable is None else executable.next_run_at
+
+    def releaseExecutable(self, exec_id):
+        self.get_query_set().filter(pk=exec_id).update(lease_expires_at=None)
+        self.dropLeases([exec_id])
+
+    def reapExpiredLeases(self):
+        with transaction.atomic():
+            expired = list(self.getExecutableWithConcurrencyWithQ(Q(status=DoozezExecutableStatus.Running) &
+                                                                  Q(lease_expires_at__lt=timezone.now()),
+                                                                  skip_locked=True).values_list('pk', flat=True))
+            return self.get_query_set().filter(pk__in=expired).update(locked_by=None, lease_expires_at=None)
+
+    def wakeExecutables(self, exec_ids):
+        # executables a worker holds locked are skipped, that worker picks up their changes anyway
+        with transaction.atomic():
+            idle = list(self.getExecutableWithConcurrencyWithQ(Q(pk__in=exec_ids), skip_locked=True)
+                        .values_list('pk', flat=True))
+            woken = self.get_query_set().filter(pk__in=idle).update(next_run_at=None)
+            if woken:
+                self.notifyExecutableCreated()
+        return woken
 
 
 class EventService(ExecutableService):
+    channel = EVENTS_CHANNEL
+    queue = 'event'
 
     def __init__(self):
         super().__init__()
@@ -450,14 +666,69 @@ class EventService(ExecutableService):
         return Event.objects
 
     def createEvent(self, event_id, created_at, resource_type, action, link_id, cause, description):
-        gc_event = GCEvent.objects.create(event_id=event_id,
-                                          gc_created_at=created_at,
-                                          resource_type=resource_type,
-                                          action=action,
-                                          link_id=link_id,
-                                          cause=cause,
-                                          description=description)
-        return self.get_query_set().create(gc_event=gc_event)
+        # None when the gateway delivered the event before
+        created = self.createEvents([dict(event_id=event_id, created_at=created_at, resource_type=resource_type,
+                                          action=action, link_id=link_id, cause=cause, description=description)])
+        return created[0] if created else None
+
+    def insertGCEvents(self, events):
+        # redelivered webhooks conflict on event_id and are skipped, returns the ids of the new rows
+        columns = ['event_id', 'gc_created_at', 'resource_type', 'action', 'link_id', 'cause', 'description']
+        rows = [(event['event_id'], event['created_at'], event['resource_type'], event['action'], event['link_id'],
+                 event['cause'], event['description']) for event in events]
+        with connection.cursor() as cursor:
+            inserted = execute_values(
+                cursor,
+                'INSERT INTO "{}" ({}) VALUES %s ON CONFLICT ("event_id") DO NOTHING RETURNING "id"'.format(
+                    GCEvent._meta.db_table, ', '.join('"{}"'.format(column) for column in columns)),
+                rows, page_size=max(1, len(rows)), fetch=True)
+        return [row[0] for row in inserted]
+
+    def createEvents(self, events):
+        if not events:
+            return []
+        with transaction.atomic():
+            gc_event_ids = self.insertGCEvents(events)
+            created = self.get_query_set().bulk_create([Event(gc_event_id=gc_event_id)
+                                                        for gc_event_id in sorted(gc_event_ids)])
+            if created:
+                self.notifyExecutableCreated()
+        # the resources changed, lookups fetch them again instead of serving the cached copies
+        for event in events:
+            evict(event['resource_type'], event['link_id'])
+        return created
+
+    def getOrderedPendingExecutable(self, priority=None):
+        # an event is only runnable once no earlier event of its link is left unfinished
+        unfinished = [DoozezExecutableStatus.Created, DoozezExecutableStatus.Running]
+        # gc_created_at holds the gateway's ISO 8601 UTC timestamps, which sort chronologically as text
+        earlier = self.get_query_set().filter(
+            Q(status__in=unfinished) & Q(gc_event__link_id=OuterRef('gc_event__link_id')) &
+            (Q(gc_event__gc_created_at__lt=OuterRef('gc_event__gc_created_at')) |
+             (Q(gc_event__gc_created_at=OuterRef('gc_event__gc_created_at')) & Q(pk__lt=OuterRef('pk')))))
+        return super().getOrderedPendingExecutable(priority).filter(
+            Q(gc_event__link_id='') | Q(gc_event__link_id__isnull=True) | ~Exists(earlier)
+        ).order_by('gc_event__gc_created_at', 'created_on')
+
+    def claimCoalescedEvents(self, event):
+        # the claimed event is the oldest unfinished one of its link, so it stays first
+        gc_event = event.gc_event
+        if not gc_event.link_id:
+            return []
+        now = timezone.now()
+        with transaction.atomic():
+            coalesced = list(self.getExecutableWithConcurrencyWithQ(
+                Q(status=DoozezExecutableStatus.Created) & Q(gc_event__resource_type=gc_event.resource_type) &
+                Q(gc_event__link_id=gc_event.link_id) & ~Q(pk=event.pk) &
+                (Q(next_run_at__isnull=True) | Q(next_run_at__lte=now)), skip_locked=True)
+                             .select_related('gc_event').order_by('gc_event__gc_created_at', 'created_on'))
+            if not coalesced:
+                return []
+            self.get_query_set().filter(pk__in=[e.pk for e in coalesced]).update(
+                status=DoozezExecutableStatus.Running, locked_by=worker_id(), lease_expires_at=lease_expiry(),
+                updated_at=now)
+        self.holdLeases([e.pk for e in coalesced])
+        return coalesced
 
     def getEventsByLinksId(self, link_id):
         return self.get_query_set().filter(gc_event__link_id=link_id).all()
@@ -467,6 +738,8 @@ class EventService(ExecutableService):
 
 
 class JobService(ExecutableService):
+    channel = JOBS_CHANNEL
+    queue = 'job'
 
     def __init__(self):
         super().__init__()
@@ -475,7 +748,9 @@ class JobService(ExecutableService):
         return DoozezJob.objects
 
     def createJob(self, job_type, user):
-        return self.get_query_set().create(job_type=job_type, user=user)
+        job = self.get_query_set().create(job_type=job_type, user=user, priority=get_job_priority(job_type))
+        self.notifyExecutableCreated()
+        return job
 
 
 class Executor(object):
@@ -492,29 +767,255 @@ class Executor(object):
     def finalizeWithFailure(self, executable_id):
         self.executable_service.finishExecutableWithFailure(executable_id)
 
+    def defer(self, executable_id, next_run_at):
+        self.executable_service.deferExecutable(executable_id, next_run_at)
+
+    def release(self, executable_id):
+        self.executable_service.releaseExecutable(executable_id)
+
+    def renewLeases(self):
+        return self.executable_service.renewLeases()
+
+    def getNextRunAt(self):
+        return self.executable_service.getNextRunAt()
+
+    def finalizeAllSuccessfully(self, executable_ids):
+        self.executable_service.finishExecutables(executable_ids, DoozezExecutableStatus.Successful)
+
+    def finalizeAllWithFailure(self, executable_ids):
+        self.executable_service.finishExecutables(executable_ids, DoozezExecutableStatus.Failed)
+
+    def deferAll(self, executable_ids, next_run_at):
+        self.executable_service.deferExecutables(executable_ids, next_run_at)
+
+    def drain(self, execute_next, max_executions, max_seconds):
+        # keeps executing until the queue is empty or the tick budget is spent
+        deadline = time.monotonic() + max_seconds
+        executed = 0
+        while executed < max_executions and time.monotonic() < deadline:
+            if execute_next() is None:
+                break
+            executed += 1
+        return executed
+
 
 class JobExecutor(object):
     logger = logging.getLogger(__name__)
     task_service = TaskService()
     executor = Executor(JobService())
 
-    def __init__(self):
-        pass
+    def __init__(self, task_pool_size=None, task_processes=None):
+        self.task_pool_size = task_pool_size or settings.DOOZEZ_TASK_POOL_SIZE
+        self.task_pool = None
+        self.task_process_pool = None
+        if task_processes is None:
+            task_processes = settings.DOOZEZ_TASK_PROCESSES
+        if task_processes > 0:
+            self.task_process_pool = TaskProcessPool(task_processes)
+        elif self.task_pool_size > 1:
+            self.task_pool = ThreadPoolExecutor(max_workers=self.task_pool_size, thread_name_prefix='doozez-task')
+
+    def runNextRunnableTaskInPool(self, job_id):
+        try:
+            return self.task_service.runNextRunnableTask(job_id)
+        finally:
+            # pool threads own their connection
+            connection.close()
+
+    def runRunnableTasks(self, job_id):
+        if self.task_process_pool is not None:
+            return self.runRunnableTasksInProcesses(job_id)
+        if self.task_pool is None:
+            task = self.task_service.runNextRunnableTask(job_id)
+            return [] if task is None else [task]
+        futures = [self.task_pool.submit(self.runNextRunnableTaskInPool, job_id) for _ in range(self.task_pool_size)]
+        tasks = []
+        errors = []
+        for future in futures:
+            try:
+                task = future.result()
+                if task is not None:
+                    tasks.append(task)
+            except Exception as ex:
+                errors.append(ex)
+        if errors:
+            raise errors[0]
+        return tasks
+
+    def runRunnableTasksInProcesses(self, job_id):
+        # claims, and the attempts they count, are committed before the worker processes read the tasks
+        tasks = []
+        for _ in range(self.task_process_pool.size):
+            task = self.task_service.claimNextRunnableTask(job_id)
+            if task is None:
+                break
+            tasks.append(task)
+        started = time.monotonic()
+        futures = [self.task_process_pool.submit(task.pk) for task in tasks]
+        errors = []
+        for task, future in zip(tasks, futures):
+            try:
+                exceptions, retryable = future.result()
+            except Exception as ex:
+                exceptions, retryable = exception_as_dict(ex, sys.exc_info()), False
+                self.task_process_pool.reset()
+            retry = retryable and RetryPolicy.from_dict(task.retry_policy).has_attempts_left(task.attempts)
+            self.task_service.recordTaskResult(task, exceptions, retry, time.monotonic() - started)
+            if task.status == DoozezTaskStatus.Failed:
+                errors.append(TaskProcessError("task {} failed: {}".format(task.pk, exceptions['message'])))
+        if errors:
+            raise errors[0]
+        return tasks
 
     def executeNextRunnableJob(self):
+        # the claim commits with its lease, so no row lock is held while the tasks call the payment gateway;
+        # concurrent workers skip the leased job and pick up a different one
         job = self.executor.runNextExecutable()
         if job is None:
             self.logger.info("no job found to process")
             return
         try:
-            task = self.task_service.runNextRunnableTask(job.pk)
-            if task is None:
-                self.logger.info("no tasks found to execute for job {}".format(job.pk))
-                self.executor.finalizeSuccessfully(job.pk)
+            tasks = self.runRunnableTasks(job.pk)
+            if not tasks:
+                if self.task_service.hasUnfinishedTasksForJob(job.pk):
+                    # only tasks waiting for a retry are left, park the job until the earliest one is due
+                    next_run_at = self.task_service.getNextRetryForJob(job.pk)
+                    if next_run_at is None:
+                        next_run_at = timezone.now() + datetime.timedelta(
+                            seconds=settings.DOOZEZ_EXECUTOR_POLL_SECONDS)
+                    self.logger.info("job {} is waiting for tasks until {}".format(job.pk, next_run_at))
+                    self.executor.defer(job.pk, next_run_at)
+                else:
+                    self.logger.info("no tasks found to execute for job {}".format(job.pk))
+                    self.executor.finalizeSuccessfully(job.pk)
+            else:
+                # the job has more tasks to run, let the next claim (by any worker) pick it up
+                self.executor.release(job.pk)
         except Exception as ex:
             self.logger.error(ex)
             self.executor.finalizeWithFailure(job.pk)
-        return
+        return job
+
+    def executeRunnableJobs(self, max_executions, max_seconds):
+        return self.executor.drain(self.executeNextRunnableJob, max_executions, max_seconds)
+
+    def renewLeases(self):
+        # heartbeat of the jobs and tasks this process is running
+        return self.executor.renewLeases() + self.task_service.renewTaskLeases()
+
+    def getNextRunAt(self):
+        return self.executor.getNextRunAt()
+
+
+# reclaims the Running jobs, events and tasks of crashed workers, i.e. whose lease was not renewed
+class LeaseReaper(object):
+    task_service = TaskService()
+    job_service = JobService()
+    event_service = EventService()
+
+    def reapExpiredLeases(self):
+        jobs = self.job_service.reapExpiredLeases()
+        events = self.event_service.reapExpiredLeases()
+        job_ids = self.task_service.reapExpiredTaskLeases()
+        if job_ids:
+            self.job_service.wakeExecutables(job_ids)
+        return jobs + events, len(job_ids)
+
+
+# archives finished executables in chunks, each in its own transaction so executors are never blocked for long
+class RetentionService(object):
+    logger = logging.getLogger(__name__)
+    finished = [DoozezExecutableStatus.Successful, DoozezExecutableStatus.Failed]
+    finished_tasks = [DoozezTaskStatus.Successful, DoozezTaskStatus.Failed]
+
+    def __init__(self, max_age=None, chunk_size=None):
+        if max_age is None:
+            max_age = datetime.timedelta(days=settings.DOOZEZ_RETENTION_DAYS)
+        self.max_age = max_age
+        self.chunk_size = chunk_size or settings.DOOZEZ_RETENTION_CHUNK_SIZE
+
+    def getCutoff(self):
+        return timezone.now() - self.max_age
+
+    def archiveJobsChunk(self, cutoff):
+        with transaction.atomic():
+            jobs = list(DoozezJob.objects.select_for_update(skip_locked=True)
+                        .filter(status__in=self.finished, updated_at__lt=cutoff)
+                        .order_by('pk')[:self.chunk_size])
+            if not jobs:
+                return 0
+            job_ids = [job.pk for job in jobs]
+            self.archiveTasks(DoozezTask.objects.filter(job__in=job_ids))
+            ArchivedDoozezJob.objects.bulk_create([
+                ArchivedDoozezJob(original_id=job.pk, status=job.status, job_type=job.job_type,
+                                  user_id=job.user_id, locked_by=job.locked_by, created_on=job.created_on,
+                                  updated_at=job.updated_at)
+                for job in jobs])
+            # every started safe keeps its job, the reference is dropped so the job can go
+            Safe.objects.filter(job__in=job_ids).update(job=None)
+            # tasks and their dependencies are deleted along with the jobs
+            DoozezJob.objects.filter(pk__in=job_ids).delete()
+        return len(jobs)
+
+    def archiveTasks(self, tasks):
+        ArchivedDoozezTask.objects.bulk_create([
+            ArchivedDoozezTask(original_id=task.pk, job_id=task.job_id, status=task.status,
+                               task_type=task.task_type, parameters=task.parameters,
+                               exceptions=task.exceptions, sequence=task.sequence, attempts=task.attempts,
+                               created_on=task.created_on, updated_at=task.updated_at)
+            for task in tasks])
+
+    def archiveOrphanTasksChunk(self, cutoff):
+        # tasks created without a job, or whose job is gone, are not archived along with a job
+        with transaction.atomic():
+            tasks = list(DoozezTask.objects.select_for_update(skip_locked=True)
+                         .filter(job__isnull=True, status__in=self.finished_tasks, updated_at__lt=cutoff)
+                         .order_by('pk')[:self.chunk_size])
+            if not tasks:
+                return 0
+            self.archiveTasks(tasks)
+            DoozezTask.objects.filter(pk__in=[task.pk for task in tasks]).delete()
+        return len(tasks)
+
+    def archiveEventsChunk(self, cutoff):
+        with transaction.atomic():
+            events = list(Event.objects.select_for_update(skip_locked=True, of=('self',))
+                          .select_related('gc_event')
+                          .filter(status__in=self.finished, updated_at__lt=cutoff)
+                          .order_by('pk')[:self.chunk_size])
+            if not events:
+                return 0
+            archived = []
+            for event in events:
+                gc_event = event.gc_event or GCEvent()
+                archived.append(ArchivedEvent(original_id=event.pk, status=event.status,
+                                              event_id=gc_event.event_id, resource_type=gc_event.resource_type,
+                                              action=gc_event.action, link_id=gc_event.link_id,
+                                              cause=gc_event.cause, description=gc_event.description,
+                                              gc_created_at=gc_event.gc_created_at, created_on=event.created_on,
+                                              updated_at=event.updated_at))
+            ArchivedEvent.objects.bulk_create(archived)
+            gc_event_ids = [event.gc_event_id for event in events if event.gc_event_id is not None]
+            Event.objects.filter(pk__in=[event.pk for event in events]).delete()
+            GCEvent.objects.filter(pk__in=gc_event_ids, event_user__isnull=True).delete()
+        return len(events)
+
+    def archiveAll(self, archive_chunk, cutoff):
+        archived = 0
+        while True:
+            count = archive_chunk(cutoff)
+            archived += count
+            if count < self.chunk_size:
+                return archived
+
+    def archiveFinished(self):
+        cutoff = self.getCutoff()
+        jobs = self.archiveAll(self.archiveJobsChunk, cutoff)
+        tasks = self.archiveAll(self.archiveOrphanTasksChunk, cutoff)
+        events = self.archiveAll(self.archiveEventsChunk, cutoff)
+        self.logger.info("archived {} jobs, {} tasks without a job and {} events finished before {}".format(
+            jobs, tasks, events, cutoff))
+        return jobs, tasks, events
 
 
 class TaskPlanner(object):
@@ -529,10 +1030,10 @@ class TaskPlanner(object):
         participations = self.particiaption_service.getActiveParticipationsForSafe(safe.pk)
         tasks = []
         task_count = 0
+        # payments are independent of each other and run concurrently, the draw waits for all of them
         for i in range(len(participations)):
             participation = participations[i]
-            parameters = '{{"participation_id":"{}", "amount":"{}", "currency":"{}"}}'. \
-                format(participation.pk, safe.monthly_payment, currency)
+            parameters = {'participation_id': participation.pk, 'amount': safe.monthly_payment, 'currency': currency}
             tasks.append(self.task_service.createTaskForJob(
                 DoozezTaskType.CreatePayment,
                 parameters,
@@ -542,14 +1043,17 @@ class TaskPlanner(object):
         task_count += 1
         tasks.append(self.task_service.createTaskForJob(
             DoozezTaskType.Draw,
-            '{{"safe_id":{}}}'.format(str(safe.pk)),
+            {'safe_id': safe.pk},
             task_count,
-            job))
+            job,
+            depends_on=list(tasks)))
         return tasks
 
     def createJobForStartSafe(self, safe, current_user):
-        job = self.job_service.createJob(DoozezJobType.StartSafe, current_user)
-        self.createTasksForStartSafe(safe, job)
+        # job and tasks become visible together, otherwise a woken up worker could finish an empty job
+        with transaction.atomic():
+            job = self.job_service.createJob(DoozezJobType.StartSafe, current_user)
+            self.createTasksForStartSafe(safe, job)
         return job
 
 
@@ -567,51 +1071,100 @@ class InstalmentService(object):
     def getSafeWithId(self, safe_id):
         return Safe.objects.get(pk=safe_id)
 
+    def getInstalmentIdempotencyKey(self, participation):
+        # one schedule per participation, whichever attempt of the task gets it created
+        return "safe-{}-participation-{}-instalments".format(participation.safe_id, participation.pk)
+
     def createInstalmentForSafe(self, safe_id, app_fee, currency):
-        participants = self.participation_service.getParticipationForSafe(safe_id)
+        # a failure rolls back the stored schedules, the idempotency keys keep the retry from duplicating them
+        participants = list(self.participation_service.getParticipationForSafe(safe_id)
+                            .select_related('payment_method__mandate'))
         safe = self.getSafeWithId(safe_id)
         total_instalments = len(participants) - 1
         total_amount = safe.monthly_payment * total_instalments * 100  # in Pence
         amounts = []
         for i in range(total_instalments):
             amounts.append(safe.monthly_payment * 100)  # in Pence
+        start_date = datetime.datetime.now() + relativedelta(months=+1)
+        installed = set(Instalment.objects.filter(participation__safe=safe_id).values_list('participation',
+                                                                                           flat=True))
+        pending = [participant for participant in participants if participant.pk not in installed]
+        if not pending:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(pending), settings.DOOZEZ_GATEWAY_CONCURRENCY),
+                                thread_name_prefix='doozez-gateway') as pool:
+            futures = [pool.submit(self.payment_gate_way_client.create_instalment_with_schedule,
+                                   "{}-installments".format(safe.name),
+                                   participant.payment_method.mandate.mandate_external_id,
+                                   total_amount, app_fee, amounts, currency, start_date, 1,
+                                   idempotency_key=self.getInstalmentIdempotencyKey(participant))
+                       for participant in pending]
         instalments = []
-        for participant in participants:
-            gc_instalment = self.payment_gate_way_client. \
-                create_instalment_with_schedule("{}-installments".format(safe.name),
-                                                participant.payment_method.mandate.mandate_external_id,
-                                                total_amount, app_fee, amounts,
-                                                currency,
-                                                datetime.datetime.now() + relativedelta(months=+1),
-                                                1)
-            instalment = Instalment.objects.create(external_id=gc_instalment.id,
-                                                   name=gc_instalment.name,
-                                                   participation=participant)
-            instalments.append(instalment)
+        failures = {}
+        for participant, future in zip(pending, futures):
+            try:
+                gc_instalment = future.result()
+            except Exception as ex:
+                failures[participant.pk] = ex
+                continue
+            instalments.append(Instalment(external_id=gc_instalment.id, name=gc_instalment.name,
+                                          participation=participant))
+        with transaction.atomic():
+            instalments = Instalment.objects.bulk_create(instalments)
+            self.payment_service.updatePendingCountersForSafe(safe_id, instalments=len(instalments))
+        if failures:
+            self.logger.error("creating instalments of safe {} failed for participations {}".format(
+                safe_id, ', '.join(str(participation_id) for participation_id in failures)))
+            raise next(iter(failures.values()))
         return instalments
 
-    def instalmentActivated(self, instalment_external_id):
-        instalment = Instalment.objects.filter(external_id=instalment_external_id).first()
+    def getInstalmentWithExternalId(self, instalment_external_id):
+        instalment = Instalment.objects.select_related('participation__payment_method__mandate') \
+            .filter(external_id=instalment_external_id).first()
         if instalment is None:
             self.logger.error("Instalment not found for {}".format(instalment_external_id))
             raise ValidationError("Instalment not found for {}".format(instalment_external_id))
-        gc_instalment = self.payment_gate_way_client.get_instalment(instalment_external_id)
-        if gc_instalment is None:
-            self.logger.error("External instalment not found for {}".format(instalment_external_id))
-            raise ValidationError("External instalment not found for {}".format(instalment_external_id))
-        for payment_id in gc_instalment.links.payments:
-            gc_payment = self.payment_gate_way_client.get_payment(payment_id)
-            if gc_payment is None:
-                self.logger.error("External payment not found for {}".format(payment_id))
-                raise ValidationError("External payment not found for {}".format(payment_id))
-            self.payment_service.createInternalPayment(instalment.participation,
-                                                       gc_payment.amount,
-                                                       gc_payment.currency,
-                                                       "",
-                                                       gc_payment.charge_date,
-                                                       gc_payment.id)
-        instalment.activated()
-        instalment.save()
+        return instalment
+
+    def getExpectedInstalmentPayments(self, instalment):
+        # createInstalmentForSafe schedules one instalment per participant but the first
+        return max(1, self.participation_service.getParticipantCountForSafe(instalment.participation.safe_id) - 1)
+
+    def instalmentActivated(self, instalment_external_id):
+        instalment = self.getInstalmentWithExternalId(instalment_external_id)
+        expected = self.getExpectedInstalmentPayments(instalment)
+        gc_payments = self.payment_gate_way_client.list_payments(
+            instalment.participation.payment_method.mandate.mandate_external_id, instalment_external_id,
+            expected=expected)
+        return self.activateInstalmentWithPayments(instalment, gc_payments, expected)
+
+    def activateInstalmentWithPayments(self, instalment, gc_payments, expected=None):
+        # raises ResourceNotReadyError until the gateway lists the `expected` payments
+        if not gc_payments or (expected is not None and len(gc_payments) < expected):
+            raise ResourceNotReadyError("only {} payments of instalment {} created yet".format(
+                len(gc_payments), instalment.external_id))
+        with transaction.atomic():
+            existing = {payment.external_id: payment for payment in Payment.objects.select_for_update().filter(
+                external_id__in=[gc_payment.id for gc_payment in gc_payments])}
+            created = []
+            for gc_payment in gc_payments:
+                payment = existing.get(gc_payment.id)
+                if payment is None:
+                    created.append(Payment(participation=instalment.participation,
+                                           amount=Money(gc_payment.amount, gc_payment.currency),
+                                           description="",
+                                           charge_date=gc_payment.charge_date,
+                                           external_id=gc_payment.id))
+                else:
+                    payment.amount = Money(gc_payment.amount, gc_payment.currency)
+                    payment.charge_date = gc_payment.charge_date
+            Payment.objects.bulk_create(created)
+            if existing:
+                Payment.objects.bulk_update(existing.values(), ['amount', 'amount_currency', 'charge_date'])
+            instalment.activated()
+            instalment.save()
+            self.payment_service.updatePendingCountersForSafe(instalment.participation.safe_id,
+                                                              payments=len(created), instalments=-1)
         return instalment
 
     def getPendingActivationInstalmentsForSafe(self, safe_id):
@@ -636,7 +1189,6 @@ class SafeService(object):
         self.payment_service = PaymentService(access_token, environment)
         self.payment_method_service = PaymentMethodService(access_token, environment)
         self.instalment_service = InstalmentService(access_token, environment)
-        self.poke_management_lock = threading.Lock()
 
     def getSafeWithId(self, safe_id):
         return Safe.objects.get(pk=safe_id)
@@ -710,20 +1262,16 @@ class SafeService(object):
         if err is not None:
             None, err
         safe_id = poke_event.get('safe_id')
-        safe = self.getSafeWithId(poke_event.get('safe_id'))
-        if safe is None or safe.status != SafeStatus.Starting:
-            return None, ValidationError("safe {} with Starting status not found".format(safe_id))
-        self.poke_management_lock.acquire()
-        try:
-            logging.info('safe lock acquired')
-            pending_payment = self.payment_service.getPendingConfirmationPaymentsForSafe(safe_id)
-            pending_instalments = self.instalment_service.getPendingActivationInstalmentsForSafe(safe_id)
-            if not (pending_payment or pending_instalments):
+        # the row lock serializes pokes of the same safe across workers and processes until the caller commits,
+        # pokes of other safes go ahead
+        with transaction.atomic():
+            safe = Safe.objects.select_for_update().filter(pk=safe_id).first()
+            if safe is None or safe.status != SafeStatus.Starting:
+                return None, ValidationError("safe {} with Starting status not found".format(safe_id))
+            # counted as payments are confirmed and instalments activated, see updatePendingCountersForSafe
+            if safe.pending_payments == 0 and safe.pending_instalments == 0:
                 safe.status = SafeStatus.Started
                 safe.save()
-        finally:
-            self.poke_management_lock.release()
-            logging.info('safe lock released')
         return safe, None
 
 
@@ -737,57 +1285,223 @@ class EventExecutor(object):
         self.instalment_service = InstalmentService(access_token, environment)
         self.safe_service = SafeService()
 
+    @doozez_event_handler(resource_type="mandates", action="active")
     def mandate_active(self, mandate_id):
         self.logger.info("processing mandate {}".format(mandate_id))
         return self.payment_method_service.mandateExternallyActivated(mandate_id)
 
+    @doozez_event_handler(resource_type="mandates", action="created")
     def mandate_created(self, mandate_id):
         self.logger.info("processing mandate {}".format(mandate_id))
         return self.payment_method_service.mandateExternallyCreated(mandate_id)
 
+    @doozez_event_handler(resource_type="mandates", action="submitted")
     def mandate_submitted(self, mandate_id):
         self.logger.info("processing mandate {}".format(mandate_id))
         return self.payment_method_service.mandateExternallySubmitted(mandate_id)
 
+    @doozez_event_handler(resource_type="payments", action="confirmed")
     def payment_confirmed(self, payment_id):
         payment = self.payment_service.paymentExternallyConfirmed(payment_id)
-        poke_event = {'safe_id':payment.participation.safe.pk, 'type': PokeType.PaymentConfirmed}
-        safe, validation_error = self.safe_service.poke(poke_event)
-        if validation_error is not None:
-            self.logger.info("completeStartSafe failed: {}".format(validation_error))
+        self.pokeSafeOf(payment, PokeType.PaymentConfirmed)
         return payment
 
+    @doozez_event_handler(resource_type="instalment_schedules", action="created")
     def instalment_created(self, instalment_id):
         instalment = self.instalment_service.instalmentActivated(instalment_id)
-        poke_event = {'safe_id': instalment.participation.safe.pk, 'type': PokeType.InstalmentActivated}
+        self.pokeSafeOf(instalment, PokeType.InstalmentActivated)
+        return instalment
+
+    def pokeSafeOf(self, resource, poke_type):
+        poke_event = {'safe_id': resource.participation.safe.pk, 'type': poke_type}
         safe, validation_error = self.safe_service.poke(poke_event)
         if validation_error is not None:
             self.logger.info("completeStartSafe failed: {}".format(validation_error))
-        return instalment
 
 
     def executeNextRunnableJob(self):
-        result = None
+        event, result = self.executeNextRunnableEvent()
+        return result
+
+    def executeRunnableJobs(self, max_executions, max_seconds):
+        return self.executor.drain(lambda: self.executeNextRunnableEvent()[0], max_executions, max_seconds)
+
+    def executeNextRunnableEvent(self):
+        # claims are committed with their lease before the handlers call the payment gateway
         event = self.executor.runNextExecutable()
         if event is None:
             self.logger.info("no event found to process")
-            return
-        options = {
-            "mandates": {
-                "active": self.mandate_active,
-                "created": self.mandate_created,
-                "submitted": self.mandate_submitted,
-            },
-            "payments": {
-                "confirmed": self.payment_confirmed,
-            },
-            "instalment_schedules": {
-                "created": self.instalment_created,
-            }
-        }
-        try:
-            result = options[event.gc_event.resource_type][event.gc_event.action](event.gc_event.link_id)
-            self.executor.finalizeSuccessfully(event.pk)
-        except:
-            self.executor.finalizeWithFailure(event.pk)
+            return None, None
+        coalesced = self.executor.executable_service.claimCoalescedEvents(event)
+        return event, self.handleEvents([event] + coalesced)
+
+    def renewLeases(self):
+        # heartbeat of the events this process is handling
+        return self.executor.renewLeases()
+
+    def getNextRunAt(self):
+        return self.executor.getNextRunAt()
+
+    def getHandler(self, resource_type, action):
+        # None for events no handler is registered for
+        name = event_handler_name(resource_type, action)
+        return None if name is None else getattr(self, name)
+
+    def handleEvent(self, event):
+        return self.handleEvents([event])
+
+    def deferNotReady(self, events):
+        # False once the events waited longer than DOOZEZ_EVENT_RETRY_MAX_SECONDS, the caller fails them
+        now = timezone.now()
+        if now - min(event.created_on for event in events) > datetime.timedelta(
+                seconds=settings.DOOZEZ_EVENT_RETRY_MAX_SECONDS):
+            return False
+        self.executor.deferAll([event.pk for event in events],
+                               now + datetime.timedelta(seconds=settings.DOOZEZ_EVENT_RETRY_SECONDS))
+        return True
+
+    def handleEvents(self, events, handlers=None):
+        # each run of an action commits with its events, so a failing or missing handler does not hold back the rest
+        result = None
+        resource_type, link_id = events[0].gc_event.resource_type, events[0].gc_event.link_id
+        # evicted here as well, the cache of this process may not be the one the webhook evicted from
+        evict(resource_type, link_id)
+        # consecutive runs of one action, interleaved actions still run in the order the gateway created them
+        actions = [(action, list(burst)) for action, burst in itertools.groupby(events, lambda e: e.gc_event.action)]
+        for position, (action, burst) in enumerate(actions):
+            event_ids = [event.pk for event in burst]
+            # `handlers` holds the handlers AsyncEventExecutor prepared while waiting on the gateway
+            handler = (handlers or {}).get(action) or self.getHandler(resource_type, action)
+            started = time.monotonic()
+            if handler is None:
+                outcome = 'unknown'
+                self.logger.warning("no handler for {} {} events".format(resource_type, action))
+                self.executor.finalizeAllWithFailure(event_ids)
+            else:
+                try:
+                    with transaction.atomic():
+                        result = handler(link_id)
+                        self.executor.finalizeAllSuccessfully(event_ids)
+                    outcome = 'success'
+                except ResourceNotReadyError as ex:
+                    remaining = [event for _, later in actions[position:] for event in later]
+                    if self.deferNotReady(remaining):
+                        self.logger.info(ex)
+                        for event in remaining:
+                            event_outcome(resource_type, event.gc_event.action, 'retry', time.monotonic() - started)
+                        return result
+                    outcome = 'failure'
+                    self.logger.error(ex)
+                    self.executor.finalizeAllWithFailure(event_ids)
+                except Exception as ex:
+                    outcome = 'failure'
+                    self.logger.error(ex)
+                    self.executor.finalizeAllWithFailure(event_ids)
+            for _ in event_ids:
+                event_outcome(resource_type, action, outcome, time.monotonic() - started)
         return result
+
+
+# keeps up to `concurrency` events in flight on one asyncio loop while they wait on the payment gateway
+class AsyncEventExecutor(object):
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, access_token=None, environment=None, concurrency=None, database_threads=None):
+        self.concurrency = concurrency or settings.DOOZEZ_ASYNC_EVENT_CONCURRENCY
+        self.event_executor = EventExecutor(access_token, environment)
+        self.payment_gate_way_client = AsyncPaymentGatewayClient(access_token, environment,
+                                                                 max_in_flight=self.concurrency)
+        # single thread executors rather than one pool, so each thread can be told to close its connection
+        self.database_executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix='doozez-database')
+            for _ in range(database_threads or settings.DOOZEZ_ASYNC_DATABASE_THREADS)]
+        self.next_database_executor = itertools.cycle(self.database_executors)
+
+    async def database(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(next(self.next_database_executor), functools.partial(func, *args))
+
+    @doozez_event_handler(resource_type="instalment_schedules", action="created", asynchronous=True)
+    async def instalment_created(self, instalment_id):
+        instalment_service = self.event_executor.instalment_service
+        instalment = await self.database(instalment_service.getInstalmentWithExternalId, instalment_id)
+        expected = await self.database(instalment_service.getExpectedInstalmentPayments, instalment)
+        gc_payments = await self.payment_gate_way_client.list_payments(
+            instalment.participation.payment_method.mandate.mandate_external_id, instalment_id, expected=expected)
+
+        # applied by handleEvents in the transaction finalizing the event
+        def activate(link_id):
+            activated = instalment_service.activateInstalmentWithPayments(instalment, gc_payments, expected)
+            self.event_executor.pokeSafeOf(activated, PokeType.InstalmentActivated)
+            return activated
+        return activate
+
+    def getAsyncHandler(self, resource_type, action):
+        # None when the event is handled synchronously by EventExecutor
+        name = event_handler_name(resource_type, action, asynchronous=True)
+        return None if name is None else getattr(self, name)
+
+    async def executeEvents(self, events):
+        # async handlers only wait on the gateway and return the handler EventExecutor runs for their events
+        resource_type, link_id = events[0].gc_event.resource_type, events[0].gc_event.link_id
+        evict(resource_type, link_id)
+        handlers = {}
+        for action in dict.fromkeys(event.gc_event.action for event in events):
+            prepare = self.getAsyncHandler(resource_type, action)
+            if prepare is None:
+                continue
+            try:
+                handlers[action] = await prepare(link_id)
+            except Exception as ex:
+                handlers[action] = functools.partial(self.reraise, ex)
+        return await self.database(self.event_executor.handleEvents, events, handlers)
+
+    @staticmethod
+    def reraise(ex, link_id):
+        raise ex
+
+    def claimNextEvents(self):
+        event = self.event_executor.executor.runNextExecutable()
+        if event is None:
+            return []
+        # handlers only get the link id, the rest of the event is read here while still in sync code
+        event.gc_event
+        return [event] + self.event_executor.executor.executable_service.claimCoalescedEvents(event)
+
+    async def executeRunnableEvents(self, max_executions, max_seconds):
+        deadline = time.monotonic() + max_seconds
+        executed = 0
+
+        async def worker():
+            nonlocal executed
+            while executed < max_executions and time.monotonic() < deadline:
+                events = await self.database(self.claimNextEvents)
+                if not events:
+                    return
+                executed += 1
+                await self.executeEvents(events)
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        finally:
+            await self.closeConnections()
+        return executed
+
+    async def closeConnections(self):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor, self.closeConnection)
+                               for executor in self.database_executors])
+
+    def closeConnection(self):
+        # runs on a database thread, which owns the connection
+        connection.close()
+
+    def renewLeases(self):
+        # heartbeat of the events in flight, called from the scheduler while the loop is busy handling them
+        return self.event_executor.renewLeases()
+
+    def getNextRunAt(self):
+        return self.event_executor.getNextRunAt()
+
+    def executeRunnableJobs(self, max_executions, max_seconds):
+        return asyncio.run(self.executeRunnableEvents(max_executions, max_seconds))
@@ -9,8 +9,6 @@ from .models import DoozezTaskType, PaymentMethodStatus, ParticipantRole
 from .services import ParticipationService, PaymentService, InstalmentService
 
 participation_service = ParticipationService()
-payment_service = PaymentService(os.environ['GC_ACCESS_TOKEN'], os.environ['GC_ENVIRONMENT'])
-installment_service = InstalmentService(os.environ['GC_ACCESS_TOKEN'], os.environ['GC_ENVIRONMENT'])
 
 
 def draw(safe_id, parti_service):
@@ -40,6 +38,10 @@ def create_payment_for_installments(safe_id, app_fee, currency, installment_serv
 
 
 def add_tasks():
+    # the gateway credentials are read when the tasks are registered, not when this module is imported
+    payment_service = PaymentService(os.environ['GC_ACCESS_TOKEN'], os.environ['GC_ENVIRONMENT'])
+    installment_service = InstalmentService(os.environ['GC_ACCESS_TOKEN'], os.environ['GC_ENVIRONMENT'])
+
     @doozez_task(type=DoozezTaskType.Draw)
     def task_draw(safe_id):
         draw(safe_id, participation_service)
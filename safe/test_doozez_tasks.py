@@ -1,3 +1,5 @@
+import importlib
+import os
 from collections import namedtuple
 from unittest import mock
 from unittest.mock import create_autospec
@@ -6,6 +8,7 @@ from django.test import TestCase
 from .decorators import doozez_task, run, clear
 from .models import DoozezTaskType, PaymentMethodStatus, ParticipantRole
 from .services import ParticipationService, PaymentService
+from . import tasks
 from .tasks import draw, create_payment_for_participant
 
 
@@ -21,6 +24,13 @@ class DoozezTaskTest(TestCase):
         result = run(type=DoozezTaskType.Draw.value, dummy="foo")
         self.assertEqual(result, "foo")
 
+    def test_import_without_gateway_credentials(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            importlib.reload(tasks)
+            with self.assertRaises(KeyError):
+                tasks.add_tasks()
+        importlib.reload(tasks)
+
     def test_draw(self):
         clear()
 
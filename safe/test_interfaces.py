@@ -1,15 +1,19 @@
 from collections import namedtuple
 
+from django.conf import settings
 from django.test import TestCase
 import os
 from unittest import mock
 
 from .client_interfaces import PaymentGatewayClient
+from . import gateway_cache
+from .gateway_cache import LocalGatewayCache
+from .services import EventService
 
 
 class InterfaceTest(TestCase):
     def setUp(self):
-        pass
+        gateway_cache.clear()
 
     def test_build_client(self):
         gate_way = PaymentGatewayClient(os.environ['GC_ACCESS_TOKEN'], 'sandbox')
@@ -51,6 +55,66 @@ class InterfaceTest(TestCase):
         }
         mock_gc.create.return_value = namedtuple("Payment", expected_dict.keys())(*expected_dict.values())
         gate_way = PaymentGatewayClient(os.environ['GC_ACCESS_TOKEN'], 'sandbox')
-        result = gate_way.create_payment(mandate_id="foo_mandate", amount=1000)
+        result = gate_way.create_payment(mandate_id="foo_mandate", amount=1000, idempotency_key="foo_key")
         self.assertEqual(result.currency, "GBP")
         self.assertEqual(result.amount, 1000)
+        self.assertEqual(mock_gc.create.call_args.kwargs['headers'], {'Idempotency-Key': "foo_key"})
+
+    def test_clients_share_pooled_session(self):
+        foo = PaymentGatewayClient(os.environ['GC_ACCESS_TOKEN'], 'sandbox').get_client()
+        bar = PaymentGatewayClient(os.environ['GC_ACCESS_TOKEN'], 'sandbox').get_client()
+        self.assertIs(foo, bar)
+        api_client = foo._api_client
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"payments": {"id": "foo"}}
+        with mock.patch.object(api_client.session, 'request', return_value=response) as request:
+            self.assertEqual(foo.payments.get("foo").id, "foo")
+        request.assert_called_once()
+        self.assertEqual(request.call_args.args[0], 'GET')
+        self.assertEqual(request.call_args.kwargs['timeout'], (settings.DOOZEZ_GATEWAY_CONNECT_TIMEOUT,
+                                                               settings.DOOZEZ_GATEWAY_READ_TIMEOUT))
+
+    @mock.patch('gocardless_pro.Client.payments')
+    def test_get_payment_is_cached_until_event(self, mock_gc):
+        links = namedtuple("PaymentLinks", ["mandate"])("foo_mandate")
+        mock_gc.get.return_value = namedtuple("Payment", ["id", "created_at", "status", "amount", "currency",
+                                                          "links", "charge_date"])(
+            "cached_payment", "2021-07-18T15:39:32.145Z", "submitted", 1000, "GBP", links, "2021-07-23")
+        gate_way = PaymentGatewayClient(os.environ['GC_ACCESS_TOKEN'], 'sandbox')
+        self.assertEqual(gate_way.get_payment("cached_payment").status, "submitted")
+        self.assertEqual(gate_way.get_payment("cached_payment").status, "submitted")
+        self.assertEqual(mock_gc.get.call_count, 1)
+        EventService().createEvent("EV_cached_payment", "2021-07-19T10:00:00.000Z", "payments", "confirmed",
+                                   "cached_payment", "cause", "description")
+        gate_way.get_payment("cached_payment")
+        self.assertEqual(mock_gc.get.call_count, 2)
+
+    @mock.patch('gocardless_pro.Client.payments')
+    def test_list_payments_stops_once_schedule_payments_matched(self, mock_gc):
+        listed = []
+
+        def payments(params):
+            # newest first, the schedule's payments come before the rest of the mandate's history
+            for i in range(1000):
+                links = mock.Mock(mandate="foo_mandate", instalment_schedule="foo_instalment" if i < 3 else None)
+                listed.append(i)
+                yield mock.Mock(id="PM{}".format(i), created_at="2021-11-01", status="pending_submission",
+                                amount=1000, currency="GBP", links=links, charge_date="2021-11-22")
+
+        mock_gc.all.side_effect = payments
+        gate_way = PaymentGatewayClient(os.environ['GC_ACCESS_TOKEN'], 'sandbox')
+        result = gate_way.list_payments("foo_mandate", "foo_instalment", expected=3)
+        self.assertEqual([payment.id for payment in result], ["PM0", "PM1", "PM2"])
+        self.assertEqual(listed, [0, 1, 2])
+
+    def test_local_gateway_cache_expires_and_evicts_least_recent(self):
+        cache = LocalGatewayCache(ttl=60, size=2)
+        cache.set("foo", 1)
+        cache.set("bar", 2)
+        cache.get("foo")
+        cache.set("baz", 3)
+        self.assertIsNone(cache.get("bar"))
+        self.assertEqual(cache.get("foo"), 1)
+        cache.ttl = 0
+        cache.set("foo", 1)
+        self.assertIsNone(cache.get("foo"))
@@ -1,31 +1,49 @@
+import datetime
+import io
 import os
+import threading
+import time
 from collections import namedtuple
 from unittest.mock import create_autospec
 
 from django.db.models import Q
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.core.exceptions import ValidationError
 from unittest import mock
 
 from djmoney.money import Money
+from django.utils import timezone
+from prometheus_client import REGISTRY
+from requests.exceptions import ConnectionError
 
-from . import utils
+from . import gateway_cache, utils
+from .benchmarks import ExecutorBenchmark
+from .client_interfaces import AsyncPaymentGatewayClient
 from .decorators import clear, doozez_task
+from .leases import worker_id
+from .listeners import ExecutableListener, EVENTS_CHANNEL
 
 from .models import Safe, PaymentMethod, InvitationStatus, Participation, ParticipantRole, PaymentMethodStatus, \
     MandateStatus, DoozezTask, DoozezTaskStatus, DoozezTaskType, DoozezJob, DoozezJobType, SafeStatus, \
     ParticipationStatus, Mandate, PaymentStatus, Invitation, DoozezExecutableStatus, Event, Instalment, \
-    InstalmentStatus, Payment, Product
+    InstalmentStatus, Payment, Product, DoozezPriority, ArchivedDoozezJob, ArchivedDoozezTask, ArchivedEvent, GCEvent
+from .metrics import QueueDepthCollector
 from .notification import NotificationProvider
+from .retry import RetryPolicy
 from .services import InvitationService, SafeService, PaymentMethodService, TaskService, UserService, \
     ParticipationService, PaymentService, TaskPlanner, JobService, JobExecutor, EventExecutor, EventService, \
-    NotificationService, EventType, InstalmentService, PokeType
+    NotificationService, EventType, InstalmentService, PokeType, LeaseReaper, \
+    RetentionService, AsyncEventExecutor, ResourceNotReadyError
 
 
 class ServiceTest(TestCase):
     def setUp(self):
         self.User = get_user_model()
+        gateway_cache.clear()
 
     def test_system_user(self):
         service = UserService()
@@ -358,6 +376,8 @@ class ServiceTest(TestCase):
         self.assertEqual(payment.status, PaymentStatus.PendingSubmission)
         self.assertEqual(str(payment.amount), '£10.00')
         self.assertEqual(str(payment.charge_date), '2021-11-10')
+        mock_ci.create_payment.assert_called_once_with(
+            "foo_mandate", 10.0, 'GBP', "safe-{}-participation-{}-payment".format(safe.pk, participation.pk))
 
     @mock.patch('safe.client_interfaces.PaymentGatewayClient')
     def test_create_cancelled_payment(self, mock_ci):
@@ -484,26 +504,50 @@ class ServiceTest(TestCase):
             Q(participation=bob_participation.pk)).all()
         self.assertEqual(len(saved_installments), 2)
 
+    @mock.patch('safe.client_interfaces.PaymentGatewayClient')
+    def test_create_installment_partial_failure(self, mock_ci):
+        GCInstalmentSchedule = namedtuple("GCInstalmentSchedule", ["id", "name"])
+        failing = {'bob_mandate'}
+        keys = []
+
+        def create_instalment_with_schedule(name, mandate_id, *args, idempotency_key=None):
+            keys.append(idempotency_key)
+            if mandate_id in failing:
+                raise ConnectionError('gateway down')
+            return GCInstalmentSchedule(id=mandate_id + '_instalment', name=name)
+
+        mock_ci.create_instalment_with_schedule.side_effect = create_instalment_with_schedule
+        instalment_service = InstalmentService(os.environ['GC_ACCESS_TOKEN'], 'sandbox')
+        instalment_service.payment_gate_way_client = mock_ci
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        bob = self.User.objects.create_user(email='bob@user.com', password='foo')
+        safe = Safe.objects.create(name='safebar', monthly_payment=10, total_participants=2, initiator=alice)
+        for user in [alice, bob]:
+            mandate = Mandate.objects.create(mandate_external_id=user.email.split('@')[0] + '_mandate')
+            Participation.objects.create(user=user, safe=safe, user_role=ParticipantRole.Participant,
+                                         payment_method=PaymentMethod.objects.create(user=user, is_default=True,
+                                                                                     mandate=mandate))
+        with self.assertRaises(ConnectionError):
+            instalment_service.createInstalmentForSafe(safe.pk, 10, 'GBP')
+        self.assertEqual(list(Instalment.objects.values_list('external_id', flat=True)), ['alice_mandate_instalment'])
+        self.assertEqual(len(set(keys)), 2)
+        failing.clear()
+        instalments = instalment_service.createInstalmentForSafe(safe.pk, 10, 'GBP')
+        self.assertEqual([instalment.external_id for instalment in instalments], ['bob_mandate_instalment'])
+        # the retried schedule is requested with the key of its first attempt
+        self.assertEqual(keys.count(keys[-1]), 2)
+        self.assertEqual(Safe.objects.get(pk=safe.pk).pending_instalments, 2)
+
     @mock.patch('safe.client_interfaces.PaymentGatewayClient')
     def test_instalment_activated(self, mock_ci):
-        expected_links = {
-            "payments": ["foo_pay_1"]
-        }
-        expected_dict = {
-            "id": "foo_instalment",
-            "name": "safebar-instalments",
-            "links": namedtuple("GCInstalmentSchedule", expected_links.keys())(*expected_links.values())
-        }
         expected_payments_dict = {
             "id": "foo_pay_1",
             "amount": 1000,
             "currency": "GBP",
             "charge_date": "2021-11-22"
         }
-        mock_ci.get_instalment.return_value = namedtuple("GCInstalmentSchedule",
-                                                         expected_dict.keys())(*expected_dict.values())
-        mock_ci.get_payment.return_value = namedtuple("GCPayments",
-                                                      expected_payments_dict.keys())(*expected_payments_dict.values())
+        mock_ci.list_payments.return_value = [namedtuple("GCPayments", expected_payments_dict.keys())(
+            *expected_payments_dict.values())]
         instalment_service = InstalmentService(os.environ['GC_ACCESS_TOKEN'], 'sandbox')
         instalment_service.payment_gate_way_client = mock_ci
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
@@ -519,17 +563,75 @@ class ServiceTest(TestCase):
                                                name="safebar-instalments",
                                                participation=alice_participation)
         instalment_service.instalmentActivated("foo_instalment")
+        mock_ci.list_payments.assert_called_once_with("alice_mandate", "foo_instalment", expected=1)
         instalment = Instalment.objects.get(pk=instalment.pk)
         self.assertEqual(instalment.status, InstalmentStatus.Active)
         payment = Payment.objects.filter(external_id="foo_pay_1").first()
         self.assertEqual(payment.charge_date.strftime("%Y-%m-%d"), "2021-11-22")
+        self.assertEqual(Safe.objects.get(pk=safe.pk).pending_payments, 1)
+
+    def test_instalment_activation_waits_for_its_payments(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        alice_payment_method = PaymentMethod.objects.create(
+            user=alice, is_default=True, mandate=Mandate.objects.create(mandate_external_id="alice_mandate"))
+        safe = Safe.objects.create(name='safebar', monthly_payment=10, total_participants=2, initiator=alice)
+        participation = Participation.objects.create(user=alice, safe=safe, user_role=ParticipantRole.Initiator,
+                                                     payment_method=alice_payment_method)
+        instalment = Instalment.objects.create(external_id="foo_instalment", name="safebar-instalments",
+                                               participation=participation)
+        event = EventService().createEvent('foo_event', '17-10-2021', 'instalment_schedules', 'created',
+                                           'foo_instalment', 'cause', 'description')
+        executor = EventExecutor()
+        executor.instalment_service.payment_gate_way_client = mock.Mock()
+        executor.instalment_service.payment_gate_way_client.list_payments.return_value = []
+        executor.executeNextRunnableEvent()
+        # the gateway has not created the schedule's payments yet, the event is handled again later
+        event = Event.objects.get(pk=event.pk)
+        self.assertEqual(event.status, DoozezExecutableStatus.Running)
+        self.assertGreater(event.next_run_at, timezone.now())
+        self.assertIsNone(event.lease_expires_at)
+        self.assertEqual(Instalment.objects.get(pk=instalment.pk).status, InstalmentStatus.Pending)
+        self.assertEqual(executor.executeNextRunnableEvent(), (None, None))
+        Event.objects.filter(pk=event.pk).update(next_run_at=timezone.now())
+        executor.instalment_service.payment_gate_way_client.list_payments.return_value = [
+            namedtuple("GCPayment", ["id", "amount", "currency", "charge_date"])(
+                "foo_pay", 1000, "GBP", "2021-11-22")]
+        executor.executeNextRunnableEvent()
+        self.assertEqual(Event.objects.get(pk=event.pk).status, DoozezExecutableStatus.Successful)
+        self.assertEqual(Instalment.objects.get(pk=instalment.pk).status, InstalmentStatus.Active)
+        # events still not ready after DOOZEZ_EVENT_RETRY_MAX_SECONDS fail
+        with self.assertRaises(ResourceNotReadyError):
+            InstalmentService().activateInstalmentWithPayments(instalment, [])
+        self.assertFalse(executor.deferNotReady([Event(created_on=timezone.now() - datetime.timedelta(days=2))]))
+
+    def test_activate_instalment_upserts_payments(self):
+        GCPayment = namedtuple("GCPayment", ["id", "amount", "currency", "charge_date"])
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        alice_payment_method = PaymentMethod.objects.create(
+            user=alice, is_default=True, mandate=Mandate.objects.create(mandate_external_id="alice_mandate"))
+        safe = Safe.objects.create(name='safebar', monthly_payment=10, total_participants=2, initiator=alice)
+        participation = Participation.objects.create(user=alice, safe=safe, user_role=ParticipantRole.Initiator,
+                                                     payment_method=alice_payment_method)
+        Payment.objects.create(external_id="foo_pay_1", participation=participation, amount=Money(10, 'GBP'),
+                               charge_date="2021-11-01")
+        instalment = Instalment.objects.create(external_id="foo_instalment", name="safebar-instalments",
+                                               participation=participation)
+        gc_payments = [GCPayment("foo_pay_{}".format(i), 1000, "GBP", "2021-{}-22".format(i)) for i in range(1, 13)]
+        with CaptureQueriesContext(connection) as queries:
+            InstalmentService().activateInstalmentWithPayments(instalment, gc_payments)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('INSERT')]), 1)
+        self.assertEqual(Payment.objects.count(), 12)
+        payment = Payment.objects.get(external_id="foo_pay_1")
+        self.assertEqual(payment.charge_date.strftime("%Y-%m-%d"), "2021-01-22")
+        self.assertEqual(payment.amount, Money(1000, 'GBP'))
+        self.assertEqual(Safe.objects.get(pk=safe.pk).pending_payments, 11)
 
     def test_safe_poke_payment_creation(self):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         alice_mandate = Mandate.objects.create(mandate_external_id="alice_mandate")
         alice_payment_method = PaymentMethod.objects.create(user=alice, is_default=True, mandate=alice_mandate)
         safe = Safe.objects.create(name='safebar', monthly_payment=10, total_participants=2,
-                                   initiator=alice, status=SafeStatus.Starting)
+                                   initiator=alice, status=SafeStatus.Starting, pending_payments=1)
         alice_participation = Participation.objects.create(user=alice,
                                                            safe=safe,
                                                            user_role=ParticipantRole.Initiator,
@@ -593,7 +695,7 @@ class ServiceTest(TestCase):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         task = DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                         parameters='{"safe_id":1}', job=job, sequence=0)
+                                         parameters={'safe_id': 1}, job=job, sequence=0)
         service = TaskService()
         result = service.runNextRunnableTask(job.pk)
         self.assertEqual(result.pk, task.pk)
@@ -610,13 +712,206 @@ class ServiceTest(TestCase):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"safe_id":1}', job=job, sequence=0)
+                                  parameters={'safe_id': 1}, job=job, sequence=0)
         service = TaskService()
         with self.assertRaises(Exception):
             service.runNextRunnableTask(job.pk)
             task = DoozezTask.objects.get(pk=1)
             self.assertEqual(task.status, DoozezTaskStatus.Failed)
-            self.assertIn('foo fail', task.exceptions)
+            self.assertIn('foo fail', task.exceptions['message'])
+
+    def test_task_retry_with_backoff(self):
+        clear()
+        calls = []
+
+        @doozez_task(type=DoozezTaskType.CreatePayment)
+        def test_create_payment(participation_id):
+            calls.append(participation_id)
+            if len(calls) == 1:
+                raise ConnectionError('gateway unreachable')
+
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        service = TaskService()
+        task = service.createTaskForJob(DoozezTaskType.CreatePayment, {'participation_id': 1}, 0, job)
+        result = service.runNextRunnableTask(job.pk)
+        self.assertEqual(result.status, DoozezTaskStatus.Pending)
+        self.assertEqual(result.attempts, 1)
+        self.assertGreater(result.next_run_at, timezone.now())
+        self.assertIn('gateway unreachable', result.exceptions['message'])
+        # still backing off
+        self.assertIsNone(service.runNextRunnableTask(job.pk))
+        DoozezTask.objects.filter(pk=task.pk).update(next_run_at=timezone.now())
+        result = service.runNextRunnableTask(job.pk)
+        self.assertEqual(result.status, DoozezTaskStatus.Successful)
+        self.assertEqual(result.attempts, 2)
+
+    def test_job_executor_parks_job_during_retry_backoff(self):
+        clear()
+
+        @doozez_task(type=DoozezTaskType.CreatePayment)
+        def test_create_payment(participation_id):
+            raise ConnectionError('gateway unreachable')
+
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        TaskService().createTaskForJob(DoozezTaskType.CreatePayment, {'participation_id': 1}, 0, job)
+        executor = JobExecutor(task_pool_size=1)
+        executed = executor.executeRunnableJobs(max_executions=100, max_seconds=60)
+        self.assertEqual(executed, 2)
+        job = DoozezJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, DoozezExecutableStatus.Running)
+        self.assertGreater(job.next_run_at, timezone.now())
+        self.assertIsNone(JobService().runNextExecutable())
+
+    def test_lease_reaper_reclaims_expired_task(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        service = TaskService()
+        task = service.createTaskForJob(DoozezTaskType.Draw, {'safe_id': 1}, 0, job)
+        claimed = service.claimNextRunnableTask(job.pk)
+        self.assertEqual(claimed.pk, task.pk)
+        self.assertIsNotNone(claimed.locked_by)
+        self.assertGreater(claimed.lease_expires_at, timezone.now())
+        # heartbeat keeps the lease alive, the reaper leaves it alone
+        DoozezTask.objects.filter(pk=task.pk).update(lease_expires_at=timezone.now())
+        self.assertEqual(service.renewTaskLeases(), 1)
+        LeaseReaper().reapExpiredLeases()
+        self.assertEqual(DoozezTask.objects.get(pk=task.pk).status, DoozezTaskStatus.Running)
+        # the worker died, the task goes back to Pending and its job is woken up
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        DoozezTask.objects.filter(pk=task.pk).update(lease_expires_at=past)
+        DoozezJob.objects.filter(pk=job.pk).update(next_run_at=timezone.now() + datetime.timedelta(hours=1))
+        LeaseReaper().reapExpiredLeases()
+        task = DoozezTask.objects.get(pk=task.pk)
+        self.assertEqual(task.status, DoozezTaskStatus.Pending)
+        self.assertIsNone(task.locked_by)
+        self.assertIsNone(DoozezJob.objects.get(pk=job.pk).next_run_at)
+        self.assertEqual(service.getNextRunableTask(job.pk).pk, task.pk)
+
+    def test_next_run_at_is_earliest_deferred_executable(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        service = JobService()
+        self.assertIsNone(service.getNextRunAt())
+        now = timezone.now()
+        later = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        sooner = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        service.deferExecutable(later.pk, now + datetime.timedelta(seconds=60))
+        service.deferExecutable(sooner.pk, now + datetime.timedelta(seconds=30))
+        self.assertEqual(service.getNextRunAt(), now + datetime.timedelta(seconds=30))
+        service.finishExecutables([sooner.pk], DoozezExecutableStatus.Successful)
+        self.assertEqual(service.getNextRunAt(), now + datetime.timedelta(seconds=60))
+
+    def test_running_executable_claimed_after_lease_expires(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        service = JobService()
+        claimed = service.runNextExecutable()
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertIsNotNone(claimed.locked_by)
+        self.assertIsNone(service.runNextExecutable())
+        DoozezJob.objects.filter(pk=job.pk).update(lease_expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(service.runNextExecutable().pk, job.pk)
+
+    def test_async_event_executor_renews_leases_in_flight(self):
+        EventService().createEvent('foo_event', '17-10-2021', 'mandates', 'active', 'foo_mandate', 'cause', 'desc')
+        executor = AsyncEventExecutor(concurrency=1)
+        event, = executor.claimNextEvents()
+        expiring = timezone.now() + datetime.timedelta(seconds=1)
+        Event.objects.filter(pk=event.pk).update(lease_expires_at=expiring)
+        self.assertEqual(executor.renewLeases(), 1)
+        self.assertGreater(Event.objects.get(pk=event.pk).lease_expires_at, expiring)
+        executor.event_executor.executor.finalizeSuccessfully(event.pk)
+        self.assertEqual(executor.renewLeases(), 0)
+
+    def test_claim_queries_use_partial_indexes(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('partial indexes are only planned on postgres')
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        with transaction.atomic(), connection.cursor() as cursor:
+            # on tiny test tables the planner would rather scan, make it show the index it would use
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            self.assertIn('safe_task_pending', TaskService().getOrderedPendingTasksForJob(job.pk).explain())
+            self.assertIn('safe_task_leased', DoozezTask.objects.filter(
+                status=DoozezTaskStatus.Running, lease_expires_at__lt=timezone.now()).explain())
+            self.assertIn('safe_doozezjob_runnable',
+                          JobService().getOrderedPendingExecutable(DoozezPriority.Normal).explain())
+            self.assertIn('safe_event_runnable',
+                          EventService().getOrderedPendingExecutable(DoozezPriority.Normal).explain())
+            self.assertIn('safe_task_parameters', TaskService().getTasksForParticipation(1).explain())
+            # queue depth counts
+            for manager, statuses in QueueDepthCollector.queues.values():
+                for status in statuses:
+                    self.assertNotIn('Seq Scan', manager.filter(status=status).explain())
+
+    def test_retention_archives_finished_executables(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        old = timezone.now() - datetime.timedelta(days=40)
+        finished = [DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice,
+                                             status=DoozezExecutableStatus.Successful) for _ in range(3)]
+        for job in finished:
+            TaskService().createTaskForJob(DoozezTaskType.Draw, {'safe_id': 1}, 0, job)
+        running = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice,
+                                           status=DoozezExecutableStatus.Running)
+        safe_job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice,
+                                            status=DoozezExecutableStatus.Successful)
+        TaskService().createTaskForJob(DoozezTaskType.Draw, {'safe_id': 1}, 0, safe_job)
+        safe = Safe.objects.create(name='safebar', monthly_payment=1, total_participants=1, initiator=alice,
+                                   job=safe_job)
+        event = EventService().createEvent('EV1', '2021-01-01', 'mandates', 'active', 'MD1', 'cause', 'desc')
+        Event.objects.filter(pk=event.pk).update(status=DoozezExecutableStatus.Failed)
+        DoozezJob.objects.update(updated_at=old)
+        Event.objects.update(updated_at=old)
+        recent = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice,
+                                          status=DoozezExecutableStatus.Failed)
+        orphan = DoozezTask.objects.create(task_type=DoozezTaskType.Draw, status=DoozezTaskStatus.Successful)
+        pending_orphan = DoozezTask.objects.create(task_type=DoozezTaskType.Draw)
+        DoozezTask.objects.filter(job__isnull=True).update(updated_at=old)
+
+        jobs, tasks, events = RetentionService(chunk_size=2).archiveFinished()
+        self.assertEqual((jobs, tasks, events), (4, 1, 1))
+        self.assertEqual(set(DoozezJob.objects.values_list('pk', flat=True)), {running.pk, recent.pk})
+        self.assertEqual(set(ArchivedDoozezJob.objects.values_list('original_id', flat=True)),
+                         {job.pk for job in finished} | {safe_job.pk})
+        # the job of a started safe is archived too, with its tasks
+        self.assertIsNone(Safe.objects.get(pk=safe.pk).job)
+        self.assertTrue(ArchivedDoozezTask.objects.filter(job_id=safe_job.pk).exists())
+        self.assertEqual(ArchivedDoozezTask.objects.count(), 5)
+        self.assertTrue(ArchivedDoozezTask.objects.filter(original_id=orphan.pk, job_id__isnull=True).exists())
+        self.assertEqual(set(DoozezTask.objects.values_list('pk', flat=True)), {pending_orphan.pk})
+        archived_event = ArchivedEvent.objects.get(original_id=event.pk)
+        self.assertEqual((archived_event.event_id, archived_event.link_id), ('EV1', 'MD1'))
+        self.assertFalse(Event.objects.exists())
+        self.assertFalse(GCEvent.objects.exists())
+        out = io.StringIO()
+        call_command('archiveexecutables', days=0, stdout=out)
+        self.assertIn("Archived 1 jobs", out.getvalue())
+        self.assertEqual(set(DoozezJob.objects.values_list('pk', flat=True)), {running.pk})
+
+    def test_executor_benchmark(self):
+        results = ExecutorBenchmark(safes=2, participants=2).run()
+        self.assertEqual(results['jobs']['count'], 2)
+        self.assertEqual(results['jobs']['failed'], 0)
+        # a payment for the system user and each participant plus the draw
+        self.assertEqual(results['tasks']['count'], 8)
+        self.assertEqual(results['events']['count'], 6)
+        self.assertEqual(results['events']['failed'], 0)
+        self.assertGreater(results['tasks']['queries_per_task'], 0)
+        self.assertIsNotNone(results['jobs']['latency_ms']['p99'])
+        self.assertEqual(Safe.objects.filter(status=SafeStatus.Started).count(), 2)
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=2.0, max_delay=5.0, jitter=0.5,
+                             retryable=['requests.exceptions.RequestException'], retryable_codes=[429])
+        self.assertTrue(policy.should_retry(1, ConnectionError()))
+        self.assertFalse(policy.should_retry(3, ConnectionError()))
+        self.assertFalse(policy.should_retry(1, ValueError()))
+        rate_limited = ValueError()
+        rate_limited.code = 429
+        self.assertTrue(policy.should_retry(1, rate_limited))
+        self.assertTrue(1.0 <= policy.next_delay(1) <= 2.0)
+        self.assertTrue(2.5 <= policy.next_delay(5) <= 5.0)
 
     def test_task_sequence(self):
         clear()
@@ -628,11 +923,11 @@ class ServiceTest(TestCase):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":10}', job=job, sequence=10)
+                                  parameters={'sequence': 10}, job=job, sequence=10)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":15}', job=job, sequence=15)
+                                  parameters={'sequence': 15}, job=job, sequence=15)
         task = DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                         parameters='{"sequence":5}', job=job, sequence=5)
+                                         parameters={'sequence': 5}, job=job, sequence=5)
         service = TaskService()
         result = service.runNextRunnableTask(job.pk)
         self.assertEqual(result.pk, task.pk)
@@ -647,25 +942,79 @@ class ServiceTest(TestCase):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":0.1}', job=job, sequence=0)
+                                  parameters={'sequence': 0.1}, job=job, sequence=0)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":0.2}', job=job, sequence=0)
+                                  parameters={'sequence': 0.2}, job=job, sequence=0)
         task = DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                         parameters='{"sequence":0.3}', job=job, sequence=0)
+                                         parameters={'sequence': 0.3}, job=job, sequence=0)
         service = TaskService()
         result = service.runNextRunnableTask(job.pk)
         self.assertEqual(result.pk, task.pk)
 
+    def test_task_waits_for_dependencies(self):
+        clear()
+
+        @doozez_task(type=DoozezTaskType.Draw)
+        def test_draw(sequence):
+            return sequence
+
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        service = TaskService()
+        payment = service.createTaskForJob(DoozezTaskType.Draw, {'sequence': 5}, 5, job)
+        draw = service.createTaskForJob(DoozezTaskType.Draw, {'sequence': 0}, 0, job, depends_on=[payment])
+        result = service.runNextRunnableTask(job.pk)
+        self.assertEqual(result.pk, payment.pk)
+        result = service.runNextRunnableTask(job.pk)
+        self.assertEqual(result.pk, draw.pk)
+
     def test_job_service_run(self):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         jobfoo = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         jobbar = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         service = JobService()
         service.runNextExecutable()
-        post_jobbar = DoozezJob.objects.get(pk=jobbar.pk)
-        self.assertEqual(post_jobbar.status, DoozezExecutableStatus.Running)
         post_jobfoo = DoozezJob.objects.get(pk=jobfoo.pk)
-        self.assertEqual(post_jobfoo.status, DoozezExecutableStatus.Created)
+        self.assertEqual(post_jobfoo.status, DoozezExecutableStatus.Running)
+        post_jobbar = DoozezJob.objects.get(pk=jobbar.pk)
+        self.assertEqual(post_jobbar.status, DoozezExecutableStatus.Created)
+
+    def test_job_service_weighted_fair_priorities(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        jobs = {}
+        for priority in [DoozezPriority.Low, DoozezPriority.Normal, DoozezPriority.High]:
+            jobs[priority] = [DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice, priority=priority)
+                              for _ in range(10)]
+        service = JobService()
+        claimed = [service.runNextExecutable() for _ in range(7)]
+        # weights 4:2:1 while every level has work, FIFO within a level
+        self.assertEqual([job.pk for job in claimed if job.priority == DoozezPriority.High],
+                         [job.pk for job in jobs[DoozezPriority.High][:4]])
+        self.assertEqual([job.pk for job in claimed if job.priority == DoozezPriority.Normal],
+                         [job.pk for job in jobs[DoozezPriority.Normal][:2]])
+        self.assertEqual([job.pk for job in claimed if job.priority == DoozezPriority.Low],
+                         [jobs[DoozezPriority.Low][0].pk])
+        self.assertEqual(claimed[0].priority, DoozezPriority.High)
+
+    def test_job_service_lone_priority_keeps_its_share(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        service = JobService()
+        low = [DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice, priority=DoozezPriority.Low)
+               for _ in range(30)]
+        # the only busy level is served every claim without running into debt
+        self.assertEqual([service.runNextExecutable().pk for _ in range(20)], [job.pk for job in low[:20]])
+        for priority in [DoozezPriority.Normal, DoozezPriority.High]:
+            for _ in range(10):
+                DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice, priority=priority)
+        claimed = [service.runNextExecutable() for _ in range(7)]
+        self.assertEqual(sorted(job.priority for job in claimed),
+                         sorted([DoozezPriority.High] * 4 + [DoozezPriority.Normal] * 2 + [DoozezPriority.Low]))
+
+    @mock.patch.dict('django.conf.settings.DOOZEZ_JOB_PRIORITIES', {DoozezJobType.StartSafe.value: 2})
+    def test_job_priority_from_settings(self):
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = JobService().createJob(DoozezJobType.StartSafe, alice)
+        self.assertEqual(job.priority, DoozezPriority.High)
 
     def test_job_executor_execute(self):
         clear()
@@ -677,12 +1026,50 @@ class ServiceTest(TestCase):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"safe_id":1}', job=job, sequence=0)
-        executor = JobExecutor()
+                                  parameters={'safe_id': 1}, job=job, sequence=0)
+        executor = JobExecutor(task_pool_size=1)
         executor.executeNextRunnableJob()
         job = DoozezJob.objects.get(pk=job.pk)
         self.assertEqual(job.status, DoozezExecutableStatus.Failed)
 
+    def test_job_executor_drains_job_in_one_tick(self):
+        clear()
+
+        @doozez_task(type=DoozezTaskType.Draw)
+        def test_draw(safe_id):
+            return safe_id
+
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        for i in range(3):
+            DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
+                                      parameters={'safe_id': 1}, job=job, sequence=i)
+        executor = JobExecutor(task_pool_size=1)
+        executed = executor.executeRunnableJobs(max_executions=100, max_seconds=60)
+        self.assertEqual(executed, 4)
+        job = DoozezJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, DoozezExecutableStatus.Successful)
+        self.assertEqual(DoozezTask.objects.filter(job=job, status=DoozezTaskStatus.Successful).count(), 3)
+
+    def test_job_executor_drain_budget(self):
+        clear()
+
+        @doozez_task(type=DoozezTaskType.Draw)
+        def test_draw(safe_id):
+            return safe_id
+
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        for i in range(3):
+            DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
+                                      parameters={'safe_id': 1}, job=job, sequence=i)
+        executor = JobExecutor(task_pool_size=1)
+        executed = executor.executeRunnableJobs(max_executions=2, max_seconds=60)
+        self.assertEqual(executed, 2)
+        job = DoozezJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, DoozezExecutableStatus.Running)
+        self.assertEqual(DoozezTask.objects.filter(job=job, status=DoozezTaskStatus.Pending).count(), 1)
+
     def test_task_service_create_task(self):
         clear()
 
@@ -693,9 +1080,9 @@ class ServiceTest(TestCase):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         service = TaskService()
-        task = service.createTaskForJob(DoozezTaskType.Draw, '{"sequence":0.1}', 15, job)
+        task = service.createTaskForJob(DoozezTaskType.Draw, {'sequence': 0.1}, 15, job)
         result = DoozezTask.objects.get(pk=task.pk)
-        self.assertEqual(result.parameters, '{"sequence":0.1}')
+        self.assertEqual(result.parameters, {'sequence': 0.1})
 
     def test_task_planner_start_safe_tasks(self):
         alice = self.User.objects.create_user(email='alice@user.com', password='foo')
@@ -726,12 +1113,13 @@ class ServiceTest(TestCase):
         planner = TaskPlanner()
         result = planner.createTasksForStartSafe(safe, job)
         self.assertEqual(len(result), 4)
+        self.assertEqual(result[3].task_type, DoozezTaskType.Draw)
+        self.assertEqual(set(result[3].depends_on.all()), set(result[:3]))
         task = DoozezTask.objects.get(pk=result[2].pk)
         self.assertEqual(task.task_type, DoozezTaskType.CreatePayment)
         self.assertEqual(task.sequence, 2)
-        self.assertEqual(
-            task.parameters,
-            '{{"participation_id":"{}", "amount":"10", "currency":"GBP"}}'.format(participation.pk))
+        self.assertEqual(task.parameters, {'participation_id': participation.pk, 'amount': 10, 'currency': 'GBP'})
+        self.assertEqual(list(TaskService().getTasksForParticipation(participation.pk)), [task])
 
     def test_event_executor(self):
         service = EventService()
@@ -750,6 +1138,171 @@ class ServiceTest(TestCase):
         event = Event.objects.get(pk=event.pk)
         self.assertEqual(event.status, DoozezExecutableStatus.Successful)
 
+    def test_event_executor_fails_unknown_events(self):
+        unknown = REGISTRY.get_sample_value('doozez_events_handled_total', dict(
+            resource_type='payouts', action='paid', outcome='unknown')) or 0
+        event = EventService().createEvent('EV1', '2021-10-17T10:00:00.000Z', 'payouts', 'paid', 'PO1', 'cause',
+                                           'description')
+        self.assertIsNone(EventExecutor().executeNextRunnableJob())
+        self.assertEqual(Event.objects.get(pk=event.pk).status, DoozezExecutableStatus.Failed)
+        self.assertEqual(REGISTRY.get_sample_value('doozez_events_handled_total', dict(
+            resource_type='payouts', action='paid', outcome='unknown')), unknown + 1)
+
+    def test_create_events_in_bulk(self):
+        events = [dict(event_id='EV{}'.format(i), created_at='2021-10-17T10:00:00.000Z', resource_type='mandates',
+                       action='active', link_id='MD{}'.format(i), cause='cause', description='description')
+                  for i in range(250)]
+        with CaptureQueriesContext(connection) as queries:
+            created = EventService().createEvents(events)
+        self.assertEqual(len(created), 250)
+        self.assertEqual(len([q for q in queries.captured_queries if q['sql'].startswith('INSERT')]), 2)
+        event = EventService().getEventByEventId('EV7')
+        self.assertEqual(event.status, DoozezExecutableStatus.Created)
+        self.assertEqual(event.gc_event.link_id, 'MD7')
+
+    def test_redelivered_events_are_ignored(self):
+        service = EventService()
+        event = service.createEvent('EV1', '2021-10-17T10:00:00.000Z', 'mandates', 'active', 'MD1', 'cause', 'desc')
+        self.assertIsNone(service.createEvent('EV1', '2021-10-17T10:00:00.000Z', 'mandates', 'active', 'MD1',
+                                              'cause', 'desc'))
+        created = service.createEvents([dict(event_id=event_id, created_at='2021-10-17T10:00:00.000Z',
+                                             resource_type='mandates', action='active', link_id='MD1',
+                                             cause='cause', description='desc')
+                                        for event_id in ['EV1', 'EV2', 'EV2']])
+        self.assertEqual(len(created), 1)
+        self.assertEqual(created[0].gc_event.event_id, 'EV2')
+        self.assertEqual(Event.objects.filter(gc_event__event_id='EV1').get().pk, event.pk)
+        self.assertEqual(GCEvent.objects.count(), 2)
+
+    def test_events_run_in_order_per_link(self):
+        service = EventService()
+        active = service.createEvent('EV2', '2021-10-17T10:00:01.000Z', 'mandates', 'active', 'MD1', 'cause',
+                                     'description')
+        submitted = service.createEvent('EV1', '2021-10-17T10:00:00.000Z', 'mandates', 'submitted', 'MD1',
+                                        'cause', 'description')
+        other = service.createEvent('EV3', '2021-10-17T10:00:02.000Z', 'mandates', 'active', 'MD2', 'cause',
+                                    'description')
+        self.assertEqual(service.runNextExecutable().pk, submitted.pk)
+        # MD1 waits for its submitted event, other links go ahead
+        self.assertEqual(service.runNextExecutable().pk, other.pk)
+        self.assertIsNone(service.runNextExecutable())
+        service.finishExecutableSuccefully(submitted.pk)
+        self.assertEqual(service.runNextExecutable().pk, active.pk)
+
+    def test_event_executor_coalesces_events_of_a_resource(self):
+        service = EventService()
+        for i, action in enumerate(['created', 'submitted', 'active', 'active']):
+            service.createEvent('EV{}'.format(i), '2021-10-17T10:00:0{}.000Z'.format(i), 'mandates', action, 'MD1',
+                                'cause', 'description')
+        other = service.createEvent('EV9', '2021-10-17T10:00:09.000Z', 'mandates', 'active', 'MD2', 'cause',
+                                    'description')
+        executor = EventExecutor()
+        handled = []
+        executor.mandate_created = lambda link_id: handled.append(('created', link_id))
+        executor.mandate_submitted = lambda link_id: handled.append(('submitted', link_id))
+        executor.mandate_active = lambda link_id: handled.append(('active', link_id))
+        self.assertEqual(executor.executeRunnableJobs(10, 10), 2)
+        self.assertEqual(handled, [('created', 'MD1'), ('submitted', 'MD1'), ('active', 'MD1'), ('active', 'MD2')])
+        self.assertEqual(Event.objects.filter(status=DoozezExecutableStatus.Successful).count(), 5)
+        self.assertEqual(Event.objects.get(pk=other.pk).status, DoozezExecutableStatus.Successful)
+
+    def test_event_executor_keeps_interleaved_actions_in_order(self):
+        service = EventService()
+        for i, action in enumerate(['active', 'submitted', 'created', 'active']):
+            service.createEvent('EV{}'.format(i), '2021-10-17T10:00:0{}.000Z'.format(i), 'mandates', action, 'MD1',
+                                'cause', 'description')
+        executor = EventExecutor()
+        handled = []
+        executor.mandate_active = lambda link_id: handled.append('active')
+        executor.mandate_submitted = lambda link_id: handled.append('submitted')
+        executor.mandate_created = lambda link_id: handled.append('created')
+        self.assertEqual(executor.executeRunnableJobs(10, 10), 1)
+        self.assertEqual(handled, ['active', 'submitted', 'created', 'active'])
+        self.assertEqual(Event.objects.filter(status=DoozezExecutableStatus.Successful).count(), 4)
+
+    def test_event_executor_finalizes_coalesced_events_by_their_own_outcome(self):
+        service = EventService()
+        events = {}
+        for i, action in enumerate(['created', 'submitted', 'submitted', 'customer_approval_granted', 'confirmed']):
+            events[i] = service.createEvent('EV{}'.format(i), '2021-10-17T10:00:0{}.000Z'.format(i), 'payments',
+                                            action, 'PM1', 'cause', 'description')
+        executor = EventExecutor()
+        handled = []
+
+        def payment_confirmed(link_id):
+            handled.append(('confirmed', link_id))
+            return link_id
+
+        executor.payment_confirmed = payment_confirmed
+        self.assertEqual(executor.executeRunnableJobs(10, 10), 1)
+        # events without a handler do not keep the burst's handled events from running
+        self.assertEqual(handled, [('confirmed', 'PM1')])
+        self.assertEqual({i: Event.objects.get(pk=event.pk).status for i, event in events.items()},
+                         {0: DoozezExecutableStatus.Failed, 1: DoozezExecutableStatus.Failed,
+                          2: DoozezExecutableStatus.Failed, 3: DoozezExecutableStatus.Failed,
+                          4: DoozezExecutableStatus.Successful})
+
+    def test_event_executor_failing_handler_only_fails_its_events(self):
+        service = EventService()
+        for i, action in enumerate(['created', 'submitted', 'active']):
+            service.createEvent('EV{}'.format(i), '2021-10-17T10:00:0{}.000Z'.format(i), 'mandates', action, 'MD1',
+                                'cause', 'description')
+        executor = EventExecutor()
+        executor.mandate_created = lambda link_id: link_id
+        executor.mandate_active = lambda link_id: link_id
+
+        def mandate_submitted(link_id):
+            raise ValidationError("foo fail")
+
+        executor.mandate_submitted = mandate_submitted
+        executor.executeRunnableJobs(10, 10)
+        self.assertEqual(list(Event.objects.order_by('gc_event__gc_created_at').values_list('status', flat=True)),
+                         [DoozezExecutableStatus.Successful, DoozezExecutableStatus.Failed,
+                          DoozezExecutableStatus.Successful])
+
+    def test_executor_metrics(self):
+        clear()
+
+        @doozez_task(type=DoozezTaskType.Draw)
+        def test_draw(safe_id):
+            return safe_id
+
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        tasks_run = sample('doozez_task_runs_total', task_type=DoozezTaskType.Draw.value, outcome='success')
+        events_handled = sample('doozez_events_handled_total', resource_type='mandates', action='active',
+                                outcome='success')
+        jobs_claimed = sample('doozez_claim_wait_seconds_count', queue='job')
+        alice = self.User.objects.create_user(email='alice@user.com', password='foo')
+        job = JobService().createJob(DoozezJobType.StartSafe, alice)
+        DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
+                                  parameters={'safe_id': 1}, job=job, sequence=0)
+        EventService().createEvent('foo_event', '17-10-2021', 'mandates', 'active', 'foo_mandate', 'cause',
+                                   'description')
+        self.assertEqual(sample('doozez_queue_depth', queue='event', status=DoozezExecutableStatus.Created.value), 1)
+        self.assertEqual(sample('doozez_queue_depth', queue='task', status=DoozezTaskStatus.Pending.value), 1)
+        JobExecutor(task_pool_size=1).executeNextRunnableJob()
+        executor = EventExecutor()
+        executor.mandate_active = lambda link_id: link_id
+        executor.executeNextRunnableJob()
+        self.assertEqual(sample('doozez_task_runs_total', task_type=DoozezTaskType.Draw.value, outcome='success'),
+                         tasks_run + 1)
+        self.assertEqual(sample('doozez_events_handled_total', resource_type='mandates', action='active',
+                                outcome='success'), events_handled + 1)
+        self.assertEqual(sample('doozez_claim_wait_seconds_count', queue='job'), jobs_claimed + 1)
+        self.assertEqual(sample('doozez_queue_depth', queue='task', status=DoozezTaskStatus.Pending.value), 0)
+        # finished rows are not counted
+        self.assertIsNone(REGISTRY.get_sample_value('doozez_queue_depth', {
+            'queue': 'task', 'status': DoozezTaskStatus.Successful.value}))
+        with self.settings(DOOZEZ_METRICS_TOKEN='foo_token'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer bar_token').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer foo_token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'doozez_queue_depth{queue="event",status="CRT"} 0.0', response.content)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
     @mock.patch('safe.client_interfaces.PaymentGatewayClient')
     def test_payment_confirmed(self, mock_ci):
         expected_dict = {
@@ -787,14 +1340,17 @@ class ServiceTest(TestCase):
                                                     10.0,
                                                     'GBP',
                                                     'description')
+        self.assertEqual(Safe.objects.get(pk=safe.pk).pending_payments, 2)
         executor = EventExecutor()
         payment = executor.payment_confirmed(alice_payment.pk)
         self.assertEqual(payment.id, alice_payment.pk)
         safe = Safe.objects.get(pk=safe.pk)
         self.assertEqual(safe.status, SafeStatus.Starting)
+        self.assertEqual(safe.pending_payments, 1)
         executor.payment_confirmed(bob_payment.pk)
         safe = Safe.objects.get(pk=safe.pk)
         self.assertEqual(safe.status, SafeStatus.Started)
+        self.assertEqual(safe.pending_payments, 0)
 
     def test_render_template(self):
         result = utils.render_template_with_context('notification/invite.txt', {'user': 'foo', 'safe': 'bar'})
@@ -816,3 +1372,240 @@ class ServiceTest(TestCase):
         expected = "foo has invited you to bar"
         self.assertEqual(expected, result.notification.body)
         utils.notification_provider = notification_provider
+
+
+def register_process_pool_tasks():
+    # initializer of the worker processes in the test_job_executor_*_in_processes tests
+    @doozez_task(type=DoozezTaskType.Draw)
+    def draw_in_process(safe_id):
+        if safe_id == 0:
+            raise ValueError(str(os.getpid()))
+        if safe_id < 0:
+            raise ConnectionError('gateway unreachable')
+
+
+class ExecutorConcurrencyTest(TransactionTestCase):
+    serialized_rollback = True
+
+    def setUp(self):
+        gateway_cache.clear()
+
+    def test_workers_claim_different_jobs(self):
+        alice = get_user_model().objects.create_user(email='alice@user.com', password='foo')
+        jobfoo = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        jobbar = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        claimed = threading.Event()
+        release = threading.Event()
+        claims = {}
+
+        def worker():
+            try:
+                with transaction.atomic():
+                    claims['worker'] = JobService().runNextExecutable().pk
+                    claimed.set()
+                    release.wait(5)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        claimed.wait(5)
+        with transaction.atomic():
+            claims['main'] = JobService().runNextExecutable().pk
+        release.set()
+        thread.join()
+        self.assertEqual(claims['worker'], jobfoo.pk)
+        self.assertEqual(claims['main'], jobbar.pk)
+
+    def test_job_claim_is_committed_before_its_tasks_run(self):
+        clear()
+        seen = {}
+
+        def other_worker(job_id):
+            try:
+                # the job is not row-locked, its committed lease keeps this worker off it
+                with transaction.atomic():
+                    job = DoozezJob.objects.select_for_update(nowait=True).get(pk=job_id)
+                    seen['status'], seen['locked_by'] = job.status, job.locked_by
+                seen['claimed'] = JobService().runNextExecutable()
+            finally:
+                connection.close()
+
+        @doozez_task(type=DoozezTaskType.Draw)
+        def test_draw(safe_id):
+            thread = threading.Thread(target=other_worker, args=(safe_id,))
+            thread.start()
+            thread.join()
+
+        alice = get_user_model().objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        TaskService().createTaskForJob(DoozezTaskType.Draw, {'safe_id': job.pk}, 0, job)
+        JobExecutor(task_pool_size=1, task_processes=0).executeNextRunnableJob()
+        self.assertEqual(seen['status'], DoozezExecutableStatus.Running)
+        self.assertEqual(seen['locked_by'], worker_id())
+        self.assertIsNone(seen['claimed'])
+
+    def test_safe_pokes_are_serialized_per_safe(self):
+        alice = get_user_model().objects.create_user(email='alice@user.com', password='foo')
+        safefoo = Safe.objects.create(name='safefoo', monthly_payment=10, total_participants=2, initiator=alice,
+                                      status=SafeStatus.Starting)
+        safebar = Safe.objects.create(name='safebar', monthly_payment=10, total_participants=2, initiator=alice,
+                                      status=SafeStatus.Starting)
+        poked = threading.Event()
+        release = threading.Event()
+        results = {}
+
+        def poke(name, safe, hold=False):
+            try:
+                with transaction.atomic():
+                    results[name] = SafeService().poke({'safe_id': safe.pk, 'type': PokeType.PaymentConfirmed})
+                    if hold:
+                        poked.set()
+                        release.wait(5)
+            finally:
+                connection.close()
+
+        holder = threading.Thread(target=poke, args=('holder', safefoo, True))
+        holder.start()
+        poked.wait(5)
+        # another safe is not held up by the poke in flight
+        poke('other', safebar)
+        self.assertEqual(results['other'][0].status, SafeStatus.Started)
+        waiter = threading.Thread(target=poke, args=('waiter', safefoo))
+        waiter.start()
+        waiter.join(0.5)
+        self.assertTrue(waiter.is_alive())
+        release.set()
+        holder.join()
+        waiter.join()
+        self.assertEqual(results['holder'][0].status, SafeStatus.Started)
+        # the safe already started when the waiting poke got its turn
+        self.assertIsNone(results['waiter'][0])
+        self.assertIsInstance(results['waiter'][1], ValidationError)
+
+    def test_listener_wakes_up_on_new_event(self):
+        notified = []
+        woken = threading.Event()
+
+        def callback(channel):
+            notified.append(channel)
+            woken.set()
+
+        listener = ExecutableListener([EVENTS_CHANNEL], callback, timeout=0.1)
+        listener.start()
+        self.assertTrue(listener.listening.wait(5))
+        EventService().createEvent('foo_event', '17-10-2021', 'mandates', 'active', 'foo_mandate',
+                                   'cause', 'description')
+        self.assertTrue(woken.wait(5))
+        listener.stop()
+        self.assertEqual(notified, [EVENTS_CHANNEL])
+
+    def test_job_executor_runs_independent_tasks_concurrently(self):
+        clear()
+        barrier = threading.Barrier(3, timeout=5)
+        finished = []
+
+        @doozez_task(type=DoozezTaskType.Draw)
+        def test_draw(safe_id):
+            if safe_id != 0:
+                # only passes when all three independent tasks run at the same time
+                barrier.wait()
+            finished.append(safe_id)
+
+        alice = get_user_model().objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        service = TaskService()
+        payments = [service.createTaskForJob(DoozezTaskType.Draw, {'safe_id': i}, i, job)
+                    for i in range(1, 4)]
+        service.createTaskForJob(DoozezTaskType.Draw, {'safe_id': 0}, 4, job, depends_on=payments)
+        executor = JobExecutor(task_pool_size=3)
+        executor.executeRunnableJobs(max_executions=10, max_seconds=30)
+        job = DoozezJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, DoozezExecutableStatus.Successful)
+        self.assertEqual(sorted(finished[:3]), [1, 2, 3])
+        self.assertEqual(finished[3], 0)
+
+    def test_async_event_executor_keeps_events_in_flight(self):
+        barrier = threading.Barrier(2, timeout=5)
+        gateway = mock.Mock()
+
+        def list_payments(mandate_id, instalment_schedule_id, page_size, expected):
+            # only passes when both instalment events wait on the gateway at the same time
+            barrier.wait()
+            return [namedtuple("GCPayment", ["id", "amount", "currency", "charge_date"])(
+                "{}_pay".format(instalment_schedule_id), 1000, "GBP", "2021-11-22")]
+
+        gateway.list_payments.side_effect = list_payments
+        alice = get_user_model().objects.create_user(email='alice@user.com', password='foo')
+        alice_mandate = Mandate.objects.create(mandate_external_id="alice_mandate")
+        alice_payment_method = PaymentMethod.objects.create(user=alice, is_default=True, mandate=alice_mandate)
+        safe = Safe.objects.create(name='safebar', monthly_payment=10, total_participants=2, initiator=alice)
+        participation = Participation.objects.create(user=alice, safe=safe, user_role=ParticipantRole.Initiator,
+                                                     payment_method=alice_payment_method)
+        service = EventService()
+        for instalment_id in ["foo_instalment", "bar_instalment"]:
+            Instalment.objects.create(external_id=instalment_id, name="safebar-instalments",
+                                      participation=participation)
+            service.createEvent(instalment_id + '_event', '17-10-2021', 'instalment_schedules', 'created',
+                                instalment_id, 'cause', 'description')
+        service.createEvent('foo_event', '17-10-2021', 'mandates', 'active', 'foo_mandate', 'cause', 'description')
+        executor = AsyncEventExecutor(concurrency=4)
+        executor.payment_gate_way_client = AsyncPaymentGatewayClient(client=gateway, max_in_flight=4)
+        executor.event_executor.mandate_active = lambda link_id: link_id
+        executed = executor.executeRunnableJobs(max_executions=10, max_seconds=30)
+        self.assertEqual(executed, 3)
+        self.assertEqual(Event.objects.filter(status=DoozezExecutableStatus.Successful).count(), 3)
+        self.assertEqual(Instalment.objects.filter(status=InstalmentStatus.Active).count(), 2)
+        self.assertEqual(set(Payment.objects.values_list('external_id', flat=True)),
+                         {"foo_instalment_pay", "bar_instalment_pay"})
+
+    def test_async_event_executor_coalesces_bursts(self):
+        service = EventService()
+        service.createEvent('foo_event', '17-10-2021', 'mandates', 'active', 'foo_mandate', 'cause', 'description')
+        service.createEvent('bar_event', '18-10-2021', 'mandates', 'active', 'foo_mandate', 'cause', 'description')
+        handled = []
+        executor = AsyncEventExecutor(concurrency=2)
+        executor.event_executor.mandate_active = lambda link_id: handled.append(link_id)
+        executed = executor.executeRunnableJobs(max_executions=10, max_seconds=30)
+        self.assertEqual(executed, 1)
+        self.assertEqual(handled, ['foo_mandate'])
+        self.assertEqual(Event.objects.filter(status=DoozezExecutableStatus.Successful).count(), 2)
+
+    def test_job_executor_runs_tasks_in_processes(self):
+        alice = get_user_model().objects.create_user(email='alice@user.com', password='foo')
+        succeeding = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        failing = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        service = TaskService()
+        service.createTaskForJob(DoozezTaskType.Draw, {'safe_id': 1}, 0, succeeding)
+        task = service.createTaskForJob(DoozezTaskType.Draw, {'safe_id': 0}, 0, failing)
+        executor = JobExecutor(task_processes=2)
+        executor.task_process_pool.initializer = 'safe.test_services.register_process_pool_tasks'
+        try:
+            executor.executeRunnableJobs(max_executions=10, max_seconds=60)
+        finally:
+            executor.task_process_pool.shutdown()
+        self.assertEqual(DoozezJob.objects.get(pk=succeeding.pk).status, DoozezExecutableStatus.Successful)
+        self.assertEqual(DoozezJob.objects.get(pk=failing.pk).status, DoozezExecutableStatus.Failed)
+        task = DoozezTask.objects.get(pk=task.pk)
+        self.assertEqual(task.status, DoozezTaskStatus.Failed)
+        # the exception was raised in a worker process
+        self.assertNotEqual(task.exceptions['message'], str(os.getpid()))
+
+    def test_job_executor_retries_tasks_in_processes_up_to_max_attempts(self):
+        alice = get_user_model().objects.create_user(email='alice@user.com', password='foo')
+        job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
+        task = TaskService().createTaskForJob(DoozezTaskType.Draw, {'safe_id': -1}, 0, job)
+        DoozezTask.objects.filter(pk=task.pk).update(retry_policy=RetryPolicy(
+            max_attempts=2, base_delay=0.01, jitter=0, retryable=['requests.exceptions.ConnectionError']).to_dict())
+        executor = JobExecutor(task_processes=1)
+        executor.task_process_pool.initializer = 'safe.test_services.register_process_pool_tasks'
+        try:
+            for _ in range(5):
+                executor.executeRunnableJobs(max_executions=10, max_seconds=60)
+                time.sleep(0.05)
+        finally:
+            executor.task_process_pool.shutdown()
+        task = DoozezTask.objects.get(pk=task.pk)
+        # the retry is decided on the attempts counted by the committed claim
+        self.assertEqual((task.status, task.attempts), (DoozezTaskStatus.Failed, 2))
+        self.assertEqual(DoozezJob.objects.get(pk=job.pk).status, DoozezExecutableStatus.Failed)
@@ -498,9 +498,9 @@ class UsersManagersTests(TestCase):
         alice = User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":0.1}', job=job, sequence=0)
+                                  parameters={'sequence': 0.1}, job=job, sequence=0)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":0.2}', job=job, sequence=0)
+                                  parameters={'sequence': 0.2}, job=job, sequence=0)
         client = APIClient()
         client.login(username='alice@user.com', password='foo')
         response = client.get(reverse('job-detail', args=[job.pk]),
@@ -513,9 +513,9 @@ class UsersManagersTests(TestCase):
         alice = User.objects.create_user(email='alice@user.com', password='foo')
         job = DoozezJob.objects.create(job_type=DoozezJobType.StartSafe, user=alice)
         DoozezTask.objects.create(status=DoozezTaskStatus.Failed, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":0.1}', job=job, sequence=0)
+                                  parameters={'sequence': 0.1}, job=job, sequence=0)
         DoozezTask.objects.create(status=DoozezTaskStatus.Pending, task_type=DoozezTaskType.Draw,
-                                  parameters='{"sequence":0.2}', job=job, sequence=0)
+                                  parameters={'sequence': 0.2}, job=job, sequence=0)
         client = APIClient()
         client.login(username='alice@user.com', password='foo')
         response = client.get(reverse('job-get-with-task-status', args=[job.pk]) + "?status=FLD",
@@ -1,3 +1,4 @@
+import hmac
 import json
 import logging
 import os
@@ -7,7 +8,7 @@ from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.contrib.auth.password_validation import validate_password, get_password_validators
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound
 from django.shortcuts import render
 from django.utils import timezone
 from django.views.generic import TemplateView
@@ -15,6 +16,7 @@ from django.db.models import Q
 from django_rest_passwordreset.models import get_password_reset_token_expiry_time, ResetPasswordToken
 from django_rest_passwordreset.signals import pre_password_reset, post_password_reset
 from gocardless_pro import webhooks
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from gocardless_pro.errors import InvalidSignatureError
 from rest_framework import viewsets
 from rest_framework import permissions, status
@@ -46,6 +48,16 @@ class ConfirmatioView(TemplateView):
         return super().get(request, *args, **kwargs)
 
 
+def metrics(request):
+    # only served to scrapers presenting DOOZEZ_METRICS_TOKEN as a bearer token
+    token = settings.DOOZEZ_METRICS_TOKEN
+    if not token:
+        return HttpResponseNotFound()
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer {}'.format(token)):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+
 class PasswordResetView(TemplateView):
     logger = logging.getLogger(__name__)
     template_name = "passwordreset/password_reset_confirm.html"
@@ -528,6 +540,7 @@ class WebhookViewSet(viewsets.ModelViewSet):
 
     def create(self, request):
         try:
+            events = []
             for event in self.get_events(request):
                 self.logger.info("Processing event {}\n".format(event.id))
                 self.logger.info("Processing event {}\n".format(event.created_at))
@@ -538,13 +551,14 @@ class WebhookViewSet(viewsets.ModelViewSet):
                     link_id = event.links.payment
                 elif event.resource_type == "instalment_schedules":
                     link_id = event.links.instalment_schedules
-                self.event_service.createEvent(event.id,
-                                               event.created_at,
-                                               event.resource_type,
-                                               event.action, link_id,
-                                               event.details.cause,
-                                               event.details.description)
-                pass
+                events.append(dict(event_id=event.id,
+                                   created_at=event.created_at,
+                                   resource_type=event.resource_type,
+                                   action=event.action,
+                                   link_id=link_id,
+                                   cause=event.details.cause,
+                                   description=event.details.description))
+            self.event_service.createEvents(events)
 
             return HttpResponse(200)
         except InvalidSignatureError: